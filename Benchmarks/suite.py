@@ -0,0 +1,226 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+# The macros are loaded the same way MacroChain loads them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'MacroChain'))
+import macro as chain  # noqa: E402
+
+# Every scenario generates its event once and then calls the macro's handler
+# with it, as the handlers don't change the fragment they're given.
+
+
+def nacl_event(scale):
+    nacls, rules = int(50 * scale) or 1, 40
+    inbound = ["%d,6,allow,10.%d.0.0/16,%d" % (100 + i, i, 1000 + i) for i in range(rules // 2)]
+    outbound = ["%d,6,allow,10.%d.0.0/16,%d-%d" % (100 + i, i, 1000 + i, 2000 + i) for i in range(rules - rules // 2)]
+    resources = {}
+    for i in range(nacls):
+        resources["Nacl%d" % i] = {
+            "Type": "AWS::EC2::NetworkAcl",
+            "Properties": {
+                "VpcId": {"Ref": "VPC"},
+                "Inbound": list(inbound),
+                "Outbound": list(outbound),
+                "Association": ["Subnet%dA" % i, "Subnet%dB" % i]
+            }
+        }
+    return "%d NACLs x %d rules" % (nacls, rules), {"Resources": resources}
+
+
+def ecr_event(scale):
+    repositories = int(300 * scale) or 1
+    resources = {"Repos": {
+        "Type": "IgnoreMe::ECR::Repository",
+        "Properties": {
+            "Repositories": ["team-%d/service-%d" % (i % 10, i) for i in range(repositories)],
+            "Tags": [{"Key": "Team", "Value": "platform"}],
+            "LifecyclePolicy": {"LifecyclePolicyText": json.dumps({"rules": [{
+                "rulePriority": 1, "description": "Expire untagged images",
+                "selection": {"tagStatus": "untagged", "countType": "sinceImagePushed", "countUnit": "days", "countNumber": 14},
+                "action": {"type": "expire"}}]})},
+            "RepositoryPolicyText": {"Version": "2012-10-17", "Statement": [{
+                "Sid": "AllowPull", "Effect": "Allow",
+                "Principal": {"AWS": ["arn:aws:iam::123456789012:root", "arn:aws:iam::210987654321:root"]},
+                "Action": ["ecr:GetDownloadUrlForLayer", "ecr:BatchGetImage", "ecr:BatchCheckLayerAvailability"]}]},
+            "ReplicationTargets": [{"Region": "us-east-1"}, {"Region": "eu-west-1"}],
+            "Exports": "Map"
+        }
+    }}
+    return "%d repositories" % repositories, {"Resources": resources}
+
+
+def sso_event(scale):
+    permission_sets, assignments = int(200 * scale) or 1, int(500 * scale) or 1
+    resources = {}
+    for i in range(permission_sets):
+        resources["PermSet%d" % i] = {
+            "Type": "AWS::SSO::PermissionSet",
+            "Properties": {
+                "Name": "PermissionSet%d" % i,
+                "PolicyDocument": {"Version": "2012-10-17", "Statement": [{
+                    "Sid": "Statement%d" % j, "Effect": "Allow",
+                    "Action": ["s3:GetObject", "s3:PutObject"],
+                    "Resource": ["arn:aws:s3:::bucket-%d-%d/*" % (i, j)]
+                } for j in range(10)]}
+            }
+        }
+    for i in range(assignments):
+        resources["Assignment%d" % i] = {
+            "Type": "AWS::SSO::Assignment",
+            "Properties": {
+                "PermissionSetArn": {"Fn::GetAtt": ["PermSet%d" % (i % permission_sets), "PermissionSetArn"]},
+                "PrincipalType": "GROUP",
+                "PrincipalName": "Group %d" % (i % 1000)
+            }
+        }
+    return "%d permission sets, %d assignments" % (permission_sets, assignments), {"Resources": resources}
+
+
+def sso_setup(module):
+    # The lookup table is already in the cache of a warm container, so the
+    # scenario doesn't need S3
+    os.environ['BUCKET_NAME'] = 'benchmark'
+    os.environ['LOOKUPTABLE_PREFIX'] = 'lookuptable.json'
+    os.environ['LOOKUPTABLE_CACHE_TTL'] = str(24 * 3600)
+    module.S3_CLIENT = object()
+    module.LOOKUP_CACHE[('benchmark', 'lookuptable.json')] = {
+        "etag": "\"benchmark\"",
+        "table": dict(("Group %d" % i, "group-%d" % i) for i in range(1000)),
+        "validated": time.time()
+    }
+
+
+def description_event(scale):
+    size = int(100000 * scale) or 1
+    fragment = {
+        "Description": "%s " + "x" * size,
+        "Resources": {"Bucket": {"Type": "AWS::S3::Bucket"}}
+    }
+    return "%d character description" % size, fragment
+
+
+# name: (macro, event generator, setup of the loaded macro)
+SCENARIOS = {
+    "nacl": ("NaclExpander", nacl_event, None),
+    "ecr": ("ECRExpander", ecr_event, None),
+    "sso": ("SSOFixer", sso_event, sso_setup),
+    "description": ("DescriptionFixer", description_event, None)
+}
+
+
+def percentile(timings, percent):
+    # Nearest rank, the timings have to be sorted
+    return timings[max(0, math.ceil(percent / 100.0 * len(timings)) - 1)]
+
+
+def run_scenario(name, scale, runs, warmup):
+    macro_name, generator, setup = SCENARIOS[name]
+    module = chain.load_macro(macro_name)
+    if setup is not None:
+        setup(module)
+    label, fragment = generator(scale)
+    event = {
+        "requestId": "benchmark",
+        "region": "ap-southeast-2",
+        "accountId": "123456789012",
+        "params": {},
+        "templateParameterValues": {"Identifier": "benchmark"},
+        "fragment": fragment
+    }
+    timings = []
+    # What the macros log isn't part of the benchmark
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for run in range(warmup + runs):
+            start = time.perf_counter()
+            response = module.handler(event, None)
+            if run >= warmup:
+                timings.append(time.perf_counter() - start)
+        if response['status'] != "success":
+            raise ValueError("%s: %s" % (name, response.get('errorMessage')))
+        # Traced separately, as tracemalloc slows down the timed runs
+        tracemalloc.start()
+        module.handler(event, None)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    timings.sort()
+    resources_in = len(fragment['Resources'])
+    resources_out = len(response['fragment']['Resources'])
+    return {
+        "label": label,
+        "resources_in": resources_in,
+        "resources_out": resources_out,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p90_ms": percentile(timings, 90) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "resources_per_second": resources_out * runs / sum(timings),
+        "peak_kib": peak / 1024.0
+    }
+
+
+def regressions(results, baseline, tolerance, floors):
+    # The scenarios that are slower, or use more memory, than the baseline
+    # allows. Differences below the floor of a metric are noise, which matters
+    # for scenarios that only take a fraction of a millisecond.
+    found = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        if baseline[name]['label'] != result['label']:
+            found.append("%s: the baseline is for %s, not %s" % (name, baseline[name]['label'], result['label']))
+            continue
+        for metric in ["p50_ms", "peak_kib"]:
+            limit = max(baseline[name][metric] * (1 + tolerance), baseline[name][metric] + floors[metric])
+            if result[metric] > limit:
+                found.append("%s: %s is %.2f, the baseline is %.2f (limit %.2f)" % (
+                    name, metric, result[metric], baseline[name][metric], limit))
+    return found
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmark the macros with generated templates")
+    parser.add_argument('scenarios', nargs='*', help="The scenarios to run (%s), all by default" % ", ".join(sorted(SCENARIOS)))
+    parser.add_argument('--runs', type=int, default=50, help="The number of timed runs per scenario")
+    parser.add_argument('--warmup', type=int, default=3, help="The number of untimed runs before them")
+    parser.add_argument('--scale', type=float, default=1.0, help="Multiplies the size of the generated templates")
+    parser.add_argument('--save', metavar='FILE', help="Store the results as the baseline in this file")
+    parser.add_argument('--baseline', metavar='FILE', help="Fail if the results are worse than the baseline in this file")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="How much worse than the baseline is allowed (0.25 is 25%%)")
+    parser.add_argument('--min-ms', type=float, default=0.5, help="Slowdowns of fewer milliseconds are always allowed")
+    parser.add_argument('--min-kib', type=float, default=64, help="Memory increases of fewer KiB are always allowed")
+    args = parser.parse_args(arguments)
+    unknown = set(args.scenarios).difference(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: %s" % ", ".join(sorted(unknown)))
+
+    results = {}
+    print("%-12s %-36s %9s %9s %9s %12s %10s" % (
+        "scenario", "size", "p50 ms", "p90 ms", "p99 ms", "resources/s", "peak KiB"))
+    for name in args.scenarios or sorted(SCENARIOS):
+        result = run_scenario(name, args.scale, args.runs, args.warmup)
+        results[name] = result
+        print("%-12s %-36s %9.2f %9.2f %9.2f %12.0f %10.1f" % (
+            name, result["label"], result["p50_ms"], result["p90_ms"], result["p99_ms"],
+            result["resources_per_second"], result["peak_kib"]))
+
+    if args.save:
+        with open(args.save, 'w') as baselinefile:
+            json.dump(results, baselinefile, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baselinefile:
+            found = regressions(results, json.load(baselinefile), args.tolerance,
+                                {"p50_ms": args.min_ms, "peak_kib": args.min_kib})
+        for regression in found:
+            print(regression, file=sys.stderr)
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
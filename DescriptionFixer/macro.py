@@ -1,14 +1,46 @@
+import json
+import os
+import time
 import traceback
 
 
+def log_metrics(event, response, start):
+    # A smaller version of the metrics in SSOFixer/macro.py, so the code still
+    # fits in the ZipFile of macro.yml
+    namespace = os.environ.get('METRICS_NAMESPACE', 'CloudFormationMacros')
+    if not namespace:
+        return
+    metrics = {
+        "InvocationTime": ((time.perf_counter() - start) * 1000, "Milliseconds"),
+        "ResourcesIn": (len(event['fragment'].get('Resources', {})), "Count"),
+        "ResourcesOut": (len(response['fragment'].get('Resources', {})), "Count")
+    }
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [["Macro"]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in metrics.items()]
+            }]
+        },
+        "Macro": "DescriptionFixer",
+        "RequestId": event.get('requestId')
+    }
+    record.update((name, value) for name, (value, _) in metrics.items())
+    print(json.dumps(record))
+
+
 def handler(event, context):
+    start = time.perf_counter()
     macro_response = {
         "requestId": event["requestId"],
         "status": "success"
     }
     # Globals
     fragment = event['fragment']
-    result = fragment
+    # Only the top level is copied, the rest is shared with the fragment
+    result = dict(fragment)
     templateParameterValues = event['templateParameterValues']
 
     identifier = templateParameterValues['Identifier'].upper()
@@ -17,4 +49,5 @@ def handler(event, context):
         result['Description'] = fragment['Description'] % identifier
 
     macro_response['fragment'] = result
+    log_metrics(event, macro_response, start)
     return macro_response
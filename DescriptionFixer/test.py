@@ -1,5 +1,10 @@
+import contextlib
+import io
+import json
+import os
 import unittest
 import macro
+from unittest import mock
 
 class TestStringMethods(unittest.TestCase):
     identifier = "TEST"
@@ -22,5 +27,23 @@ class TestStringMethods(unittest.TestCase):
         fragment = result["fragment"]
         self.assertEqual(fragment['Description'], "static template")
 
+    def test_fragment_not_changed(self):
+        self.event["fragment"] = {"Description": "%s template"}
+        result = macro.handler(self.event, None)
+        self.assertEqual(self.event["fragment"]['Description'], "%s template")
+        self.assertEqual(result["fragment"]['Description'], "TEST template")
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": "CloudFormationMacros"})
+    def test_metrics_logged(self):
+        self.event["fragment"] = {"Description": "%s template", "Resources": {"Bucket": {"Type": "AWS::S3::Bucket"}}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(self.event, None)
+        metrics = json.loads(output.getvalue())
+        self.assertEqual(metrics["_aws"]["CloudWatchMetrics"][0]["Dimensions"], [["Macro"]])
+        self.assertEqual(metrics["Macro"], "DescriptionFixer")
+        self.assertEqual((metrics["ResourcesIn"], metrics["ResourcesOut"]), (1, 1))
+        self.assertGreaterEqual(metrics["InvocationTime"], 0)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,59 +1,322 @@
+import hashlib
+import json
+import os
 import re
+from functools import lru_cache
 
-REG = r"(.*?)[-_]([a-zA-Z])"
+from macrokit import instrumented, transform_resources
 
-def camel(match):
-    return match.group(1) + match.group(2).upper()
+# Everything CloudFormation doesn't allow in a logical ID. Repository names
+# are split on these, e.g. team/my-service becomes teamMyService.
+SEPARATORS = re.compile(r"[^A-Za-z0-9]+")
 
-def handler(event, context):
+# Logical IDs can be 255 characters, leave room for the Output suffix
+LOGICAL_ID_LIMIT = 255 - len("Output")
+
+# The logical ID of the generated replication configuration. A registry has
+# only one, so it covers the repositories of all groups in the template.
+REPLICATION_RESOURCE = "ECRReplicationConfiguration"
+
+# The values of the Exports property, besides a list of repositories
+EXPORT_MODES = ['All', 'None', 'Map']
+
+# The maximum size of an (advanced) SSM parameter value
+PARAMETER_VALUE_LIMIT = 8192
+
+# Past this size (in bytes) the policies shared by repositories are moved to
+# Mappings, so they're only in the template once
+POLICY_MAPPING = "ECRExpanderPolicies"
+POLICY_MAPPING_REFERENCE_SIZE = len(json.dumps({"Fn::FindInMap": [POLICY_MAPPING, "", ""]}))
+
+# ECR limits for a replication configuration
+REPLICATION_RULE_LIMIT = 10
+REPLICATION_FILTER_LIMIT = 100
+
+
+@lru_cache(maxsize=4096)
+def camelise(repository):
+    parts = SEPARATORS.split(repository)
+    resourcename = parts[0] + "".join(part[:1].upper() + part[1:] for part in parts[1:])
+    return resourcename[:LOGICAL_ID_LIMIT] or "Repository"
+
+
+def logical_id_owners(fragment):
+    # The repository that gets each camelised name as its logical ID. When the
+    # names of repositories collide it's the smallest name, so which one gets
+    # the ID doesn't depend on the order of the repositories or groups.
+    owners = {}
+    # A registry can only have one repository with a name
+    seen = set()
+    for resource, definition in fragment['Resources'].items():
+        if definition.get('Type') in RESOURCE_HANDLERS:
+            for repository in definition.get('Properties', {}).get('Repositories', []):
+                if repository in seen:
+                    raise ValueError("%s: repository %s is listed more than once" % (resource, repository))
+                seen.add(repository)
+                resourcename = camelise(repository)
+                if resourcename not in owners or repository < owners[resourcename]:
+                    owners[resourcename] = repository
+    return owners
+
+
+def logical_id(repository, taken, owners):
+    # The camelised name, unless another resource already has that or another
+    # repository owns it. Then a suffix based on the repository name is added,
+    # so the ID doesn't depend on the order or number of the other repositories.
+    resourcename = camelise(repository)
+    if resourcename in taken or owners.get(resourcename, repository) != repository:
+        suffix = hashlib.sha256(repository.encode('utf-8')).hexdigest()[:8]
+        resourcename = resourcename[:LOGICAL_ID_LIMIT - len(suffix)] + suffix
+        if resourcename in taken:
+            raise ValueError("%s: can't create a unique logical ID" % repository)
+    taken.add(resourcename)
+    return resourcename
+
+
+def replication_destinations(resource, targets, region):
+    destinations = []
+    for target in targets:
+        if not isinstance(target, dict) or "Region" not in target:
+            raise ValueError("%s: every ReplicationTarget needs a Region" % resource)
+        destination = {
+            "Region": target['Region'],
+            "RegistryId": target.get('RegistryId', {"Ref": "AWS::AccountId"})
+        }
+        if destination == {"Region": region, "RegistryId": {"Ref": "AWS::AccountId"}}:
+            raise ValueError("%s: can't replicate to the registry the repositories are in" % resource)
+        if destination not in destinations:
+            destinations.append(destination)
+    return destinations
+
+
+def add_replication(resource, properties, replication, region):
+    # Groups the repositories by their destinations, so each distinct set of
+    # destinations is built once and ends up in a single rule
+    if "ReplicationTargets" not in properties:
+        return
+    destinations = replication_destinations(resource, properties['ReplicationTargets'], region)
+    if not destinations:
+        return
+    # The order of the destinations doesn't matter
+    key = tuple(sorted(json.dumps(destination, sort_keys=True) for destination in destinations))
+    if key not in replication:
+        replication[key] = (destinations, [])
+    replication[key][1].extend(properties.get('Repositories', []))
+
+
+def replication_configuration(replication):
+    # Repositories are matched by prefix, a rule can have a limited number of
+    # them so larger groups are split over several rules
+    rules = []
+    for destinations, repositories in replication.values():
+        for start in range(0, len(repositories), REPLICATION_FILTER_LIMIT):
+            rules.append({
+                "Destinations": destinations,
+                "RepositoryFilters": [{"Filter": repository, "FilterType": "PREFIX_MATCH"}
+                                      for repository in repositories[start:start + REPLICATION_FILTER_LIMIT]]
+            })
+    if len(rules) > REPLICATION_RULE_LIMIT:
+        raise ValueError("%s: needs %d replication rules, more than the limit of %d" % (
+            REPLICATION_RESOURCE, len(rules), REPLICATION_RULE_LIMIT))
+    return {
+        "Type": "AWS::ECR::ReplicationConfiguration",
+        "Properties": {
+            "ReplicationConfiguration": {"Rules": rules}
+        }
+    }
+
+
+def repository_map(repositories):
+    # A JSON object with the ARN of every repository by its name, filled in by
+    # CloudFormation
+    arns = dict((repository, "${%s.Arn}" % resourcename) for repository, resourcename in repositories)
+    return {"Fn::Sub": json.dumps(arns, separators=(',', ':'))}
+
+
+def repository_output(resourcename):
+    return {
+        "Value": { "Ref": resourcename },
+        "Export": {
+            "Name": { "Fn::Join": ["-", ["ECR-REPO", resourcename]]}
+        }
+    }
+
+
+def add_exports(resource, properties, repositories, taken, owners, region):
+    # Outputs for every repository (the default), the selected ones, none, or
+    # a single one with all of them in a map
+    exports = properties.get('Exports', 'All')
+    if isinstance(exports, list):
+        unknown = set(exports).difference(repository for repository, _ in repositories)
+        if unknown:
+            raise ValueError("%s: Exports has repositories that aren't in Repositories: %s" % (
+                resource, ", ".join(sorted(unknown))))
+        selected = set(exports)
+    elif exports in EXPORT_MODES:
+        selected = set(repository for repository, _ in repositories) if exports == 'All' else set()
+    else:
+        raise ValueError("%s: Exports must be a list of repositories or one of %s" % (resource, ", ".join(EXPORT_MODES)))
+
+    for repository, resourcename in repositories:
+        if repository in selected:
+            yield "Outputs", resourcename + "Output", repository_output(resourcename)
+    if exports == 'Map':
+        yield "Outputs", resource + "Output", {
+            "Value": repository_map(repositories),
+            "Export": {
+                "Name": { "Fn::Join": ["-", ["ECR-REPOS", resource]]}
+            }
+        }
+    if "ExportParameter" in properties:
+        # Estimated with an ARN of arn:aws:ecr:<region>:<account>:repository/<name>
+        size = sum(len(repository) * 2 + len(region or "") + 40 for repository, _ in repositories)
+        if size > PARAMETER_VALUE_LIMIT:
+            raise ValueError("%s: the ExportParameter would be about %d bytes, more than the limit of %d" % (
+                resource, size, PARAMETER_VALUE_LIMIT))
+        yield "Resources", logical_id(resource + "Parameter", taken, owners), {
+            "Type": "AWS::SSM::Parameter",
+            "Properties": {
+                "Name": properties['ExportParameter'],
+                "Type": "String",
+                "Tier": "Intelligent-Tiering",
+                "Value": repository_map(repositories)
+            }
+        }
+
+
+def policy_hoist_threshold():
+    return int(os.environ.get('POLICY_HOIST_THRESHOLD', '512000'))
+
+
+def is_literal(value):
+    # Mappings can't contain intrinsic functions
+    if isinstance(value, dict):
+        return all(not (key == "Ref" or key.startswith("Fn::")) and is_literal(item) for key, item in value.items())
+    if isinstance(value, list):
+        return all(is_literal(item) for item in value)
+    return True
+
+
+def shared_policies(properties, group):
+    # The policies of a group that are worth moving to Mappings, as strings
+    policies = {}
+    policytext = properties.get('RepositoryPolicyText')
+    if policytext is not None and is_literal(policytext):
+        if not isinstance(policytext, str):
+            policytext = json.dumps(policytext, separators=(',', ':'))
+        policies['RepositoryPolicyText'] = policytext
+    lifecycle = properties.get('LifecyclePolicy')
+    if isinstance(lifecycle, dict) and isinstance(lifecycle.get('LifecyclePolicyText'), str):
+        policies['LifecyclePolicyText'] = lifecycle['LifecyclePolicyText']
+    return dict((key, policy) for key, policy in policies.items()
+                if len(policy) + len(group) + len(key) > POLICY_MAPPING_REFERENCE_SIZE)
+
+
+def hoist_policies(fragment, result, expanded):
+    # Replaces the policies of groups with more than one repository by a
+    # reference to a single copy in Mappings
+    mapping = {}
+    for group, resourcenames in expanded.items():
+        if len(resourcenames) < 2:
+            continue
+        policies = shared_policies(fragment['Resources'][group]['Properties'], group)
+        if not policies:
+            continue
+        mapping[group] = policies
+        for resourcename in resourcenames:
+            # The generated properties are the macro's own, only the
+            # LifecyclePolicy is shared with the fragment
+            properties = result['Resources'][resourcename]['Properties']
+            if 'RepositoryPolicyText' in policies:
+                properties['RepositoryPolicyText'] = {"Fn::FindInMap": [POLICY_MAPPING, group, 'RepositoryPolicyText']}
+            if 'LifecyclePolicyText' in policies:
+                properties['LifecyclePolicy'] = dict(properties['LifecyclePolicy'])
+                properties['LifecyclePolicy']['LifecyclePolicyText'] = {"Fn::FindInMap": [POLICY_MAPPING, group, 'LifecyclePolicyText']}
+    if mapping:
+        if POLICY_MAPPING in fragment.get('Mappings', {}):
+            raise ValueError("%s: already exists in the template" % POLICY_MAPPING)
+        result['Mappings'] = dict(fragment.get('Mappings', {}))
+        result['Mappings'][POLICY_MAPPING] = mapping
+
+
+def expand_repositories(resource, definition, taken, owners, expanded, replication, region):
+    properties = definition['Properties']
+    add_replication(resource, properties, replication, region)
+    if "Repositories" not in properties:
+        yield "Resources", resource, definition
+        return
+    tags_to_copy = properties.get("Tags", "")
+    lifecycle_to_copy = properties.get("LifecyclePolicy", "")
+    policytext_to_copy = properties.get("RepositoryPolicyText", "")
+    repositories = []
+    for repository in properties['Repositories']:
+        resourcename = logical_id(repository, taken, owners)
+
+        repo_fragment = {
+            "Type": "AWS::ECR::Repository",
+            "Properties": {
+                "RepositoryName": repository
+            }
+        }
+        # The Tags and policies are shared by all generated repositories
+        # and with the original fragment, none of them are changed.
+        if tags_to_copy != "":
+            repo_fragment['Properties']['Tags'] = tags_to_copy
+        if lifecycle_to_copy != "":
+            repo_fragment['Properties']['LifecyclePolicy'] = lifecycle_to_copy
+        if policytext_to_copy != "":
+            repo_fragment['Properties']['RepositoryPolicyText'] = policytext_to_copy
+        yield "Resources", resourcename, repo_fragment
+        repositories.append((repository, resourcename))
+    expanded[resource] = [resourcename for _, resourcename in repositories]
+    yield from add_exports(resource, properties, repositories, taken, owners, region)
+
+
+# Handlers per resource Type for macrokit.transform_resources. Each receives
+# the logical ID, the resource definition, the logical IDs that are in use,
+# the repository that owns each camelised logical ID, the logical IDs of the
+# generated repositories by group, the repositories to replicate by their
+# destinations, and the region of the stack.
+RESOURCE_HANDLERS = {
+    'IgnoreMe::ECR::Repository': expand_repositories
+}
+
+
+@instrumented("ECRExpander")
+def handler(event, context, metrics):
     macro_response = {
         "requestId": event["requestId"],
         "status": "success"
     }
     # Globals
     fragment = event['fragment']
-    result = fragment
-    for resource in list(fragment["Resources"].keys()):
-        if fragment['Resources'][resource]['Type'] == 'IgnoreMe::ECR::Repository':
-            tags_to_copy = ""
-            lifecycle_to_copy = ""
-            policytext_to_copy = ""
-            if "Tags" in fragment['Resources'][resource]['Properties']:
-                tags_to_copy = fragment['Resources'][resource]['Properties']['Tags']
-            if "LifecyclePolicy" in fragment['Resources'][resource]['Properties']:
-                lifecycle_to_copy = fragment['Resources'][resource]['Properties']['LifecyclePolicy']
-            if "RepositoryPolicyText" in fragment['Resources'][resource]['Properties']:
-                policytext_to_copy = fragment['Resources'][resource]['Properties']['RepositoryPolicyText']
-            if "Repositories" in fragment['Resources'][resource]['Properties']:
-                for repository in fragment['Resources'][resource]['Properties']['Repositories']:
-                    resourcename = re.sub(REG, camel, repository, 0)
-
-                    repo_fragment = {
-                        "Type": "AWS::ECR::Repository",
-                        "Properties": {
-                            "RepositoryName": repository
-                        }
-                    }
-                    if tags_to_copy != "":
-                        repo_fragment['Properties']['Tags'] = tags_to_copy
-                    if lifecycle_to_copy != "":
-                        repo_fragment['Properties']['LifecyclePolicy'] = lifecycle_to_copy
-                    if policytext_to_copy != "":
-                        repo_fragment['Properties']['RepositoryPolicyText'] = policytext_to_copy
-                    result['Resources'][resourcename] = repo_fragment
-
-                    outputname = resourcename + "Output"
-                    output_frament = {
-                        "Value": { "Ref": resourcename },
-                        "Export": {
-                            "Name": { "Fn::Join": ["-", ["ECR-REPO", resourcename]]}
-                        }
-                    }
-                    if "Outputs" not in result:
-                        result['Outputs'] = {}
-                    result['Outputs'][outputname] = output_frament
-                result['Resources'].pop(resource)
 
+    # Generated repositories can't replace the other resources, but can use the
+    # logical ID of a group as that's removed
+    taken = set(resource for resource, definition in fragment['Resources'].items()
+                if definition.get('Type') not in RESOURCE_HANDLERS)
+    expanded = {}
+    replication = {}
+    try:
+        with metrics.phase("Expand"):
+            owners = logical_id_owners(fragment)
+            result = transform_resources(fragment, RESOURCE_HANDLERS, taken, owners, expanded, replication, event.get('region'))
+            if replication:
+                if REPLICATION_RESOURCE in result['Resources']:
+                    raise ValueError("%s: already exists in the template" % REPLICATION_RESOURCE)
+                result['Resources'][REPLICATION_RESOURCE] = replication_configuration(replication)
+        metrics.add("Repositories", sum(len(repositories) for repositories in expanded.values()))
+        with metrics.phase("Serialise"):
+            size = len(json.dumps(result, separators=(',', ':')))
+        metrics.add("TemplateSize", size, "Bytes")
+        if size > policy_hoist_threshold():
+            print("Template is %d bytes, moving shared policies to Mappings" % size)
+            with metrics.phase("Hoist"):
+                hoist_policies(fragment, result, expanded)
+    except ValueError as error:
+        macro_response['status'] = "failure"
+        macro_response['errorMessage'] = str(error)
+        return macro_response
 
     macro_response['fragment'] = result
     return macro_response
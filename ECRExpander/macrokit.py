@@ -0,0 +1 @@
+../macrokit.py
\ No newline at end of file
@@ -1,6 +1,10 @@
+import contextlib
+import io
 import macro
 import json
+import os
 import unittest
+from unittest import mock
 
 
 class TestStringMethods(unittest.TestCase):
@@ -121,5 +125,252 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(fragment["Resources"]["testRepo"]["Type"], "AWS::ECR::Repository")
         self.assertEqual(fragment["Resources"]["testRepo"]["Properties"]["RepositoryPolicyText"], tags)
 
+    def testRepoWithSameNameAsGroupIsKept(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Repos": {
+            "Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["Repos", "second-repo"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        expected_resources = ["Repos", "secondRepo"]
+        expected_resources.sort()
+        actual_resources = list(fragment["Resources"].keys())
+        actual_resources.sort()
+        self.assertEqual(expected_resources, actual_resources)
+        self.assertEqual(fragment["Resources"]["Repos"]["Type"], "AWS::ECR::Repository")
+        self.assertEqual(fragment["Resources"]["Repos"]["Properties"]["RepositoryName"], "Repos")
+
+    def testFragmentIsNotChanged(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Repos": {
+            "Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}},
+            "Outputs": {"Existing": {"Value": "test"}}}
+        original = json.dumps(event["fragment"])
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertEqual(json.dumps(event["fragment"]), original)
+        actual_outputs = list(fragment["Outputs"].keys())
+        actual_outputs.sort()
+        self.assertEqual(["Existing", "testRepoOutput"], actual_outputs)
+
+    def testReplicationTargetsCreateConfiguration(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        targets = [{"Region": "us-east-1"}, {"Region": "eu-west-1", "RegistryId": "123456789012"}]
+        event["fragment"] = {"Resources": {
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+                "Repositories": ["test_repo", "second-repo"], "ReplicationTargets": targets}},
+            "OtherRepos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+                "Repositories": ["third-repo"], "ReplicationTargets": list(reversed(targets))}},
+            "LocalRepos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+                "Repositories": ["local-repo"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertNotIn("ReplicationTargets", fragment["Resources"]["testRepo"]["Properties"])
+        configuration = fragment["Resources"]["ECRReplicationConfiguration"]
+        self.assertEqual(configuration["Type"], "AWS::ECR::ReplicationConfiguration")
+        rules = configuration["Properties"]["ReplicationConfiguration"]["Rules"]
+        self.assertEqual(len(rules), 1)
+        self.assertEqual(rules[0]["Destinations"], [
+            {"Region": "us-east-1", "RegistryId": {"Ref": "AWS::AccountId"}},
+            {"Region": "eu-west-1", "RegistryId": "123456789012"}])
+        self.assertEqual([f["Filter"] for f in rules[0]["RepositoryFilters"]], ["test_repo", "second-repo", "third-repo"])
+        self.assertEqual(rules[0]["RepositoryFilters"][0]["FilterType"], "PREFIX_MATCH")
+
+    def testReplicationRulesAreSplit(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        repositories = ["repo-%d" % i for i in range(250)]
+        event["fragment"] = {"Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+            "Repositories": repositories, "ReplicationTargets": [{"Region": "us-east-1"}]}}}}
+        result = macro.handler(event, None)
+        rules = result["fragment"]["Resources"]["ECRReplicationConfiguration"]["Properties"]["ReplicationConfiguration"]["Rules"]
+        self.assertEqual([len(rule["RepositoryFilters"]) for rule in rules], [100, 100, 50])
+        self.assertIs(rules[0]["Destinations"], rules[1]["Destinations"])
+
+    def testReplicationToOwnRegionFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+            "Repositories": ["test_repo"], "ReplicationTargets": [{"Region": "ap-southeast-2"}]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "Repos: can't replicate to the registry the repositories are in")
+
+    def testTooManyReplicationRulesFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+            "Repositories": ["repo-%d" % i for i in range(1001)], "ReplicationTargets": [{"Region": "us-east-1"}]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "ECRReplicationConfiguration: needs 11 replication rules, more than the limit of 10")
+
+    def testLogicalIdsAreSanitised(self):
+        self.assertEqual(macro.camelise("team/my-service"), "teamMyService")
+        self.assertEqual(macro.camelise("team/service.v2_1"), "teamServiceV21")
+        self.assertEqual(macro.camelise("test_repo"), "testRepo")
+        self.assertEqual(macro.camelise("/"), "Repository")
+        self.assertEqual(len(macro.camelise("a" * 300)), 249)
+
+    def testCollidingLogicalIdsGetSuffix(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "teamService": {"Type": "AWS::S3::Bucket"},
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+                "Repositories": ["team/service", "team-service"]}}}}
+        result = macro.handler(event, None)
+        resources = result["fragment"]["Resources"]
+        self.assertEqual(resources["teamService"]["Type"], "AWS::S3::Bucket")
+        names = dict((resource["Properties"]["RepositoryName"], logical_id) for logical_id, resource in resources.items()
+                     if resource["Type"] == "AWS::ECR::Repository")
+        self.assertEqual(len(set(names.values())), 2)
+        # The suffix only depends on the repository name
+        event["fragment"]["Resources"]["Repos"]["Properties"]["Repositories"].reverse()
+        reordered = macro.handler(event, None)["fragment"]["Resources"]
+        self.assertEqual(reordered[names["team-service"]]["Properties"]["RepositoryName"], "team-service")
+
+    def testCollidingLogicalIdsDontDependOnOrder(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+                "Repositories": ["team/service", "team-service"]}}}}
+        resources = macro.handler(event, None)["fragment"]["Resources"]
+        # The smallest name gets the ID without a suffix
+        self.assertEqual(resources["teamService"]["Properties"]["RepositoryName"], "team-service")
+        names = dict((resource["Properties"]["RepositoryName"], logical_id) for logical_id, resource in resources.items())
+        event["fragment"]["Resources"]["Repos"]["Properties"]["Repositories"].reverse()
+        reordered = macro.handler(event, None)["fragment"]["Resources"]
+        self.assertEqual(dict((resource["Properties"]["RepositoryName"], logical_id) for logical_id, resource in reordered.items()), names)
+
+    def testDuplicateRepositoryFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["a", "b"]}},
+            "MoreRepos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["a"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "MoreRepos: repository a is listed more than once")
+        event["fragment"]["Resources"] = {
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["a", "a"]}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["errorMessage"], "Repos: repository a is listed more than once")
+
+    def exportsEvent(self, **properties):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        properties["Repositories"] = ["test_repo", "second-repo"]
+        event["fragment"] = {"Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": properties}}}
+        return event
+
+    def testExportsNone(self):
+        result = macro.handler(self.exportsEvent(Exports="None"), None)
+        self.assertNotIn("Outputs", result["fragment"])
+        self.assertEqual(sorted(result["fragment"]["Resources"].keys()), ["secondRepo", "testRepo"])
+
+    def testExportsSelected(self):
+        result = macro.handler(self.exportsEvent(Exports=["second-repo"]), None)
+        self.assertEqual(list(result["fragment"]["Outputs"].keys()), ["secondRepoOutput"])
+
+    def testExportsUnknownRepositoryFails(self):
+        result = macro.handler(self.exportsEvent(Exports=["third-repo"]), None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "Repos: Exports has repositories that aren't in Repositories: third-repo")
+
+    def testExportsMap(self):
+        result = macro.handler(self.exportsEvent(Exports="Map"), None)
+        outputs = result["fragment"]["Outputs"]
+        self.assertEqual(list(outputs.keys()), ["ReposOutput"])
+        self.assertEqual(outputs["ReposOutput"]["Value"],
+                         {"Fn::Sub": "{\"test_repo\":\"${testRepo.Arn}\",\"second-repo\":\"${secondRepo.Arn}\"}"})
+        self.assertEqual(outputs["ReposOutput"]["Export"]["Name"], {"Fn::Join": ["-", ["ECR-REPOS", "Repos"]]})
+
+    def testExportParameter(self):
+        result = macro.handler(self.exportsEvent(Exports="None", ExportParameter="/ecr/repositories"), None)
+        parameter = result["fragment"]["Resources"]["ReposParameter"]
+        self.assertEqual(parameter["Type"], "AWS::SSM::Parameter")
+        self.assertEqual(parameter["Properties"]["Name"], "/ecr/repositories")
+        self.assertEqual(json.loads(parameter["Properties"]["Value"]["Fn::Sub"]),
+                         {"test_repo": "${testRepo.Arn}", "second-repo": "${secondRepo.Arn}"})
+
+    def policiesEvent(self, policytext, repositories):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        lifecycle = {"LifecyclePolicyText": json.dumps({"rules": [{"rulePriority": 1, "description": "Expire untagged images",
+            "selection": {"tagStatus": "untagged", "countType": "sinceImagePushed", "countUnit": "days", "countNumber": 14},
+            "action": {"type": "expire"}}]})}
+        event["fragment"] = {"Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {
+            "Repositories": repositories, "RepositoryPolicyText": policytext, "LifecyclePolicy": lifecycle}}},
+            "Mappings": {"Existing": {"Key": {"Value": "test"}}}}
+        return event
+
+    def testSharedPoliciesKeptBelowThreshold(self):
+        policytext = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::123456789012:user/Bob"}, "Action": "ecr:BatchGetImage"}]}
+        result = macro.handler(self.policiesEvent(policytext, ["test_repo", "second-repo"]), None)
+        fragment = result["fragment"]
+        self.assertEqual(fragment["Resources"]["testRepo"]["Properties"]["RepositoryPolicyText"], policytext)
+        self.assertEqual(list(fragment["Mappings"].keys()), ["Existing"])
+
+    @mock.patch.dict(os.environ, {"POLICY_HOIST_THRESHOLD": "0"})
+    def testSharedPoliciesMovedToMappings(self):
+        policytext = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::123456789012:user/Bob"}, "Action": "ecr:BatchGetImage"}]}
+        event = self.policiesEvent(policytext, ["test_repo", "second-repo"])
+        original = json.dumps(event["fragment"])
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertEqual(json.dumps(event["fragment"]), original)
+        mapping = fragment["Mappings"]["ECRExpanderPolicies"]["Repos"]
+        self.assertEqual(json.loads(mapping["RepositoryPolicyText"]), policytext)
+        self.assertEqual(mapping["LifecyclePolicyText"], event["fragment"]["Resources"]["Repos"]["Properties"]["LifecyclePolicy"]["LifecyclePolicyText"])
+        self.assertEqual(fragment["Mappings"]["Existing"], {"Key": {"Value": "test"}})
+        for repository in ["testRepo", "secondRepo"]:
+            properties = fragment["Resources"][repository]["Properties"]
+            self.assertEqual(properties["RepositoryPolicyText"], {"Fn::FindInMap": ["ECRExpanderPolicies", "Repos", "RepositoryPolicyText"]})
+            self.assertEqual(properties["LifecyclePolicy"]["LifecyclePolicyText"], {"Fn::FindInMap": ["ECRExpanderPolicies", "Repos", "LifecyclePolicyText"]})
+
+    @mock.patch.dict(os.environ, {"POLICY_HOIST_THRESHOLD": "0"})
+    def testPoliciesWithIntrinsicsStayInPlace(self):
+        policytext = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Principal": {"AWS": {"Fn::Sub": "arn:aws:iam::${AWS::AccountId}:root"}}, "Action": "ecr:BatchGetImage"}]}
+        result = macro.handler(self.policiesEvent(policytext, ["test_repo", "second-repo"]), None)
+        fragment = result["fragment"]
+        self.assertEqual(fragment["Resources"]["testRepo"]["Properties"]["RepositoryPolicyText"], policytext)
+        self.assertNotIn("RepositoryPolicyText", fragment["Mappings"]["ECRExpanderPolicies"]["Repos"])
+
+    @mock.patch.dict(os.environ, {"POLICY_HOIST_THRESHOLD": "0"})
+    def testPoliciesOfSingleRepositoryStayInPlace(self):
+        policytext = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::123456789012:user/Bob"}, "Action": "ecr:BatchGetImage"}]}
+        result = macro.handler(self.policiesEvent(policytext, ["test_repo"]), None)
+        fragment = result["fragment"]
+        self.assertEqual(fragment["Resources"]["testRepo"]["Properties"]["RepositoryPolicyText"], policytext)
+        self.assertNotIn("ECRExpanderPolicies", fragment["Mappings"])
+
+    @mock.patch.dict(os.environ, {"POLICY_HOIST_THRESHOLD": "0", "METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsLoggedAsEMF(self):
+        policytext = {"Version": "2012-10-17", "Statement": [{"Effect": "Allow", "Principal": {"AWS": "arn:aws:iam::123456789012:root"}, "Action": "ecr:BatchGetImage"}]}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(self.policiesEvent(policytext, ["test_repo", "second-repo"]), None)
+        metrics, = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+        names = [metric["Name"] for metric in metrics["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        self.assertEqual(metrics["Macro"], "ECRExpander")
+        self.assertEqual((metrics["ResourcesIn"], metrics["ResourcesOut"], metrics["Repositories"]), (1, 2, 2))
+        for name in ["ExpandTime", "SerialiseTime", "TemplateSize", "HoistTime", "InvocationTime"]:
+            self.assertIn(name, names)
+
 if __name__ == '__main__':
     unittest.main()
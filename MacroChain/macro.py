@@ -0,0 +1,72 @@
+import importlib.util
+import os
+
+from macrokit import instrumented
+
+# The other macros live in sibling directories, each with its own macro.py.
+MACRO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MACROS = "NaclExpander,ECRExpander,SSOFixer"
+
+# Macro modules are only loaded when a template asks for them, and are then
+# kept for as long as the Lambda container stays warm.
+LOADED_MACROS = {}
+
+
+def load_macro(name):
+    if name not in LOADED_MACROS:
+        path = os.path.join(MACRO_ROOT, name, 'macro.py')
+        if name == "MacroChain" or os.path.sep in name or not os.path.isfile(path):
+            raise ValueError("Unknown macro %s" % name)
+        spec = importlib.util.spec_from_file_location(name + "Macro", path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        LOADED_MACROS[name] = module
+    return LOADED_MACROS[name]
+
+
+def configured_macros(event):
+    # The Transform parameters take precedence over the function's default
+    macros = event.get('params', {}).get('Macros')
+    if macros is None:
+        macros = os.environ.get('MACROS', DEFAULT_MACROS)
+    if isinstance(macros, str):
+        macros = macros.split(',')
+    return [macro.strip() for macro in macros if macro.strip() != ""]
+
+
+@instrumented("MacroChain")
+def handler(event, context, metrics):
+    macro_response = {
+        "requestId": event["requestId"],
+        "status": "success"
+    }
+    # Globals
+    fragment = event['fragment']
+    result = fragment
+
+    # Every macro in the chain logs its own metrics as well
+    for name in configured_macros(event):
+        metrics.add("Macros", 1)
+        try:
+            with metrics.phase("Load"):
+                macro = load_macro(name)
+        except ValueError as error:
+            macro_response['status'] = "failure"
+            macro_response['errorMessage'] = str(error)
+            return macro_response
+        step_event = dict(event)
+        step_event['fragment'] = result
+        try:
+            step_response = macro.handler(step_event, context)
+        except Exception as error:
+            # A macro that crashes fails the chain like any other failure
+            macro_response['status'] = "failure"
+            macro_response['errorMessage'] = "%s: %s: %s" % (name, type(error).__name__, error)
+            return macro_response
+        if step_response['status'] != "success":
+            step_response['requestId'] = event["requestId"]
+            return step_response
+        result = step_response['fragment']
+
+    macro_response['fragment'] = result
+    return macro_response
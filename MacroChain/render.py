@@ -0,0 +1,225 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+import macro
+
+# Renders templates locally: every macro in the Transform section that exists
+# in this repository is applied with its own handler, in order, the same way
+# CloudFormation would call its Lambda function.
+
+TEMPLATE_EXTENSIONS = ('.yml', '.yaml', '.json', '.template')
+
+# What render_file returns besides an error message
+RENDERED = None
+SKIPPED = "skipped"
+
+
+class TemplateLoader(yaml.SafeLoader):
+    pass
+
+
+# Dates stay strings, like they are for CloudFormation
+TemplateLoader.yaml_implicit_resolvers = dict(
+    (first, [(tag, regexp) for tag, regexp in resolvers if tag != 'tag:yaml.org,2002:timestamp'])
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items())
+
+
+def construct_intrinsic(loader, tag_suffix, node):
+    # The short form of an intrinsic function (!Ref, !Sub, ...) in its long form
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+    if tag_suffix in ['Ref', 'Condition']:
+        return {tag_suffix: value}
+    if tag_suffix == 'GetAtt' and isinstance(value, str):
+        value = value.split('.', 1)
+    return {"Fn::" + tag_suffix: value}
+
+
+TemplateLoader.add_multi_constructor('!', construct_intrinsic)
+
+
+def load_template(path):
+    with open(path, encoding='utf-8') as templatefile:
+        return yaml.load(templatefile, Loader=TemplateLoader)
+
+
+def transforms(template):
+    # The Transform section as (name, parameters) pairs
+    section = template.get('Transform', [])
+    if not isinstance(section, list):
+        section = [section]
+    for transform in section:
+        if isinstance(transform, dict):
+            yield transform.get('Name'), transform.get('Parameters', {})
+        else:
+            yield transform, {}
+
+
+def local_handler(name):
+    # The handler of a macro in this repository, or None if it isn't one
+    if name == "MacroChain":
+        return macro.handler
+    try:
+        return macro.load_macro(name).handler
+    except ValueError:
+        return None
+
+
+def parameter_values(template, parameters):
+    # The parameter defaults from the template, overridden by the given values
+    values = {}
+    for name, definition in template.get('Parameters', {}).items():
+        if isinstance(definition, dict) and 'Default' in definition:
+            values[name] = definition['Default']
+    values.update(parameters)
+    return values
+
+
+def render(template, region, account, parameters, name="template"):
+    # Returns the rendered template and the transforms that were left as they
+    # aren't in this repository. Raises ValueError when a macro fails.
+    result = dict(template)
+    result.pop('Transform', None)
+    remaining = []
+    for index, (transform, params) in enumerate(transforms(template)):
+        transform_handler = local_handler(transform)
+        if transform_handler is None:
+            remaining.append(transform)
+            continue
+        event = {
+            "requestId": "%s-%d" % (name, index),
+            "region": region,
+            "accountId": account,
+            "transformId": "%s::%s" % (account, transform),
+            "params": params,
+            "templateParameterValues": parameter_values(template, parameters),
+            "fragment": result
+        }
+        # What the macros log goes to stderr, stdout can be the template
+        with contextlib.redirect_stdout(sys.stderr):
+            response = transform_handler(event, None)
+        if response['status'] != "success":
+            raise ValueError("%s: %s" % (transform, response.get('errorMessage', response['status'])))
+        result = response['fragment']
+    if remaining:
+        result['Transform'] = remaining
+    return result, remaining
+
+
+def render_file(source, destination, region, account, parameters):
+    # Renders one template into the destination (stdout if it's None) and
+    # returns RENDERED, SKIPPED, or an error message. A template that fails
+    # in any way doesn't stop the others from being rendered.
+    try:
+        template = load_template(source)
+        if not isinstance(template, dict) or 'Resources' not in template:
+            print("%s: not a CloudFormation template, skipped" % source, file=sys.stderr)
+            return SKIPPED
+        result, remaining = render(template, region, account, parameters, os.path.basename(source))
+        output = json.dumps(result, indent=2) + "\n"
+        if destination is None:
+            sys.stdout.write(output)
+        else:
+            os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+            with open(destination, 'w', encoding='utf-8') as outputfile:
+                outputfile.write(output)
+    except (OSError, ValueError, KeyError, yaml.YAMLError) as error:
+        return "%s: %s" % (source, error)
+    except Exception as error:
+        return "%s: %s: %s" % (source, type(error).__name__, error)
+    if remaining:
+        print("%s: left the transforms %s" % (source, ", ".join(map(str, remaining))), file=sys.stderr)
+    return RENDERED
+
+
+def find_templates(paths):
+    # (source, path relative to the output directory) for every template
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for filename in sorted(files):
+                    if filename.endswith(TEMPLATE_EXTENSIONS):
+                        source = os.path.join(root, filename)
+                        yield source, os.path.relpath(source, path)
+        else:
+            yield path, os.path.basename(path)
+
+
+def output_path(output, relative):
+    return os.path.join(output, os.path.splitext(relative)[0] + '.json')
+
+
+def output_collisions(output, templates):
+    # An error for every output file that more than one template would be
+    # written to, like foo.yml and foo.json, and the sources involved
+    sources = {}
+    for source, relative in templates:
+        sources.setdefault(output_path(output, relative), []).append(source)
+    errors = []
+    colliding = set()
+    for destination, names in sources.items():
+        if len(names) > 1:
+            errors.append("%s: would all be written to %s" % (", ".join(names), destination))
+            colliding.update(names)
+    return errors, colliding
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Render CloudFormation templates with the macros in this repository")
+    parser.add_argument('paths', nargs='+', help="Templates, or directories with templates")
+    parser.add_argument('-o', '--output', help="The directory to write the rendered templates to (as JSON). Without it a single template is written to stdout.")
+    parser.add_argument('-r', '--region', default=os.environ.get('AWS_REGION', 'us-east-1'), help="The region passed to the macros")
+    parser.add_argument('-a', '--account', default='123456789012', help="The account ID passed to the macros")
+    parser.add_argument('-p', '--parameter', action='append', default=[], metavar='KEY=VALUE', help="A template parameter value, can be repeated")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="The number of templates to render at the same time")
+    args = parser.parse_args(arguments)
+
+    parameters = dict(parameter.split('=', 1) for parameter in args.parameter)
+    templates = list(find_templates(args.paths))
+    total = len(templates)
+    errors = []
+    if args.output is None:
+        if len(templates) != 1:
+            parser.error("--output is required when rendering more than one template")
+        results = [render_file(templates[0][0], None, args.region, args.account, parameters)]
+    else:
+        # Templates that would overwrite each other aren't rendered at all
+        errors, colliding = output_collisions(args.output, templates)
+        templates = [(source, relative) for source, relative in templates if source not in colliding]
+        if args.jobs <= 1 or len(templates) <= 1:
+            results = [render_file(source, output_path(args.output, relative), args.region, args.account, parameters)
+                       for source, relative in templates]
+        else:
+            # Every worker process loads the macros once and then reuses them.
+            # Templates are sent in chunks, so there are fewer round trips.
+            count = len(templates)
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                results = list(executor.map(
+                    render_file,
+                    [source for source, _ in templates],
+                    [output_path(args.output, relative) for _, relative in templates],
+                    [args.region] * count, [args.account] * count, [parameters] * count,
+                    chunksize=max(1, count // (args.jobs * 4))))
+    skipped = results.count(SKIPPED)
+    errors.extend(result for result in results if result not in [RENDERED, SKIPPED])
+    for error in errors:
+        print(error, file=sys.stderr)
+    if args.output is not None:
+        rendered = results.count(RENDERED)
+        print("Rendered %d of %d templates (%d skipped, %d failed)" % (
+            rendered, total, skipped, total - rendered - skipped), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
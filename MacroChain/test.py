@@ -0,0 +1,213 @@
+import contextlib
+import io
+import json
+import macro
+import mock
+import os
+import render
+import tempfile
+import unittest
+
+
+class TestStringMethods(unittest.TestCase):
+    def testNaclAndEcrAppliedInOrder(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": ["NaclExpander", "ECRExpander"]}
+        event["fragment"] = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/0,443"]}},
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["requestId"], "testRequest")
+        fragment = result["fragment"]
+        expected_resources = ["NaclPublic", "NaclPublicInbound100", "testRepo"]
+        expected_resources.sort()
+        actual_resources = list(fragment["Resources"].keys())
+        actual_resources.sort()
+        self.assertEqual(expected_resources, actual_resources)
+        self.assertEqual(
+            fragment["Resources"]["NaclPublicInbound100"]["Type"], "AWS::EC2::NetworkAclEntry")
+        self.assertEqual(fragment["Resources"]["testRepo"]["Type"], "AWS::ECR::Repository")
+        self.assertEqual(list(fragment["Outputs"].keys()), ["testRepoOutput"])
+
+    def testMacrosAsCommaSeparatedString(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": "ECRExpander, DescriptionFixer"}
+        event["templateParameterValues"] = {"Identifier": "test"}
+        event["fragment"] = {"Description": "%s template", "Resources": {
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertEqual(fragment["Description"], "TEST template")
+        self.assertEqual(list(fragment["Resources"].keys()), ["testRepo"])
+
+    @mock.patch.dict(os.environ, {"MACROS": "NaclExpander"})
+    def testDefaultMacrosFromEnvironment(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Association": ["SubnetA"]}},
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        expected_resources = ["NaclPublic", "Repos", "SubnetANaclPublic"]
+        expected_resources.sort()
+        actual_resources = list(fragment["Resources"].keys())
+        actual_resources.sort()
+        self.assertEqual(expected_resources, actual_resources)
+
+    def testUnknownMacroFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": ["NaclExpander", "DoesNotExist"]}
+        event["fragment"] = {"Resources": {}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "Unknown macro DoesNotExist")
+
+    def testDefaultMacrosWithoutIdentifier(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["templateParameterValues"] = {}
+        event["fragment"] = {"Resources": {"S3Bucket": {"Type": "AWS::S3::Bucket"}}}
+        with mock.patch.dict(os.environ):
+            os.environ.pop("MACROS", None)
+            result = macro.handler(event, None)
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(list(result["fragment"]["Resources"].keys()), ["S3Bucket"])
+
+    def testCrashingMacroFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": ["DescriptionFixer"]}
+        event["templateParameterValues"] = {}
+        event["fragment"] = {"Description": "%s template", "Resources": {}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["requestId"], "testRequest")
+        self.assertEqual(result["errorMessage"], "DescriptionFixer: KeyError: 'Identifier'")
+
+    def testChainCannotLoadItself(self):
+        self.assertRaises(ValueError, lambda: macro.load_macro("MacroChain"))
+
+    def testFragmentIsNotChanged(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": ["NaclExpander", "ECRExpander"]}
+        event["fragment"] = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/0,443"]}},
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}}}
+        original = json.dumps(event["fragment"])
+        first = macro.handler(event, None)
+        second = macro.handler(event, None)
+        self.assertEqual(json.dumps(event["fragment"]), original)
+        self.assertEqual(first["fragment"], second["fragment"])
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsLoggedPerMacro(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["params"] = {"Macros": ["NaclExpander", "ECRExpander"]}
+        event["fragment"] = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/0,443"]}},
+            "Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(event, None)
+        records = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+        self.assertEqual([record["Macro"] for record in records], ["NaclExpander", "ECRExpander", "MacroChain"])
+        chain = records[-1]
+        self.assertEqual((chain["Macros"], chain["ResourcesIn"], chain["ResourcesOut"]), (2, 2, 3))
+        self.assertIn("LoadTime", chain)
+
+    def testRenderAppliesTransformsInOrder(self):
+        template = {"Description": "%s registries", "Parameters": {"Identifier": {"Type": "String", "Default": "test"}},
+            "Resources": {"Repos": {"Type": "IgnoreMe::ECR::Repository", "Properties": {"Repositories": ["test_repo"]}}},
+            "Transform": ["ECRExpander", "AWS::Serverless-2016-10-31", {"Name": "DescriptionFixer"}]}
+        result, remaining = render.render(template, "ap-southeast-2", "123456789012", {})
+        self.assertEqual(result["Description"], "TEST registries")
+        self.assertEqual(list(result["Resources"].keys()), ["testRepo"])
+        self.assertEqual(remaining, ["AWS::Serverless-2016-10-31"])
+        self.assertEqual(result["Transform"], remaining)
+
+    def testRenderFailingMacro(self):
+        template = {"Resources": {"NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/33,443"]}}},
+            "Transform": "NaclExpander"}
+        self.assertRaises(ValueError, render.render, template, "ap-southeast-2", "123456789012", {})
+
+    def testLoadTemplateWithShortForms(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "template.yml")
+            with open(path, "w") as templatefile:
+                templatefile.write("AWSTemplateFormatVersion: 2010-09-09\nResources:\n  Subnet:\n    Type: AWS::EC2::Subnet\n"
+                                   "    Properties:\n      VpcId: !Ref VPC\n      AvailabilityZone: !Select [0, !GetAZs '']\n"
+                                   "      CidrBlock: !GetAtt VPC.CidrBlock\n")
+            template = render.load_template(path)
+        self.assertEqual(template["AWSTemplateFormatVersion"], "2010-09-09")
+        properties = template["Resources"]["Subnet"]["Properties"]
+        self.assertEqual(properties["VpcId"], {"Ref": "VPC"})
+        self.assertEqual(properties["AvailabilityZone"], {"Fn::Select": [0, {"Fn::GetAZs": ""}]})
+        self.assertEqual(properties["CidrBlock"], {"Fn::GetAtt": ["VPC", "CidrBlock"]})
+
+    def testRenderDirectoryInParallel(self):
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as output:
+            for index in range(3):
+                os.makedirs(os.path.join(source, "team%d" % index))
+                with open(os.path.join(source, "team%d" % index, "repos.yml"), "w") as templatefile:
+                    templatefile.write("Resources:\n  Repos:\n    Type: IgnoreMe::ECR::Repository\n"
+                                       "    Properties:\n      Repositories: [repo-%d]\nTransform: ECRExpander\n" % index)
+            self.assertEqual(render.main([source, "--output", output, "--jobs", "2"]), 0)
+            with open(os.path.join(output, "team2", "repos.json")) as renderedfile:
+                rendered = json.load(renderedfile)
+        self.assertEqual(list(rendered["Resources"].keys()), ["repo2"])
+        self.assertNotIn("Transform", rendered)
+
+    def testRenderCountsSkippedAndFailedTemplates(self):
+        templates = {
+            "repos.yml": "Resources:\n  Repos:\n    Type: IgnoreMe::ECR::Repository\n"
+                         "    Properties:\n      Repositories: [repo]\nTransform: ECRExpander\n",
+            "config.yml": "setting: value\n",
+            # Not a ValueError, but it still only fails this template
+            "broken.yml": "Resources:\n  Repos:\n    Type: IgnoreMe::ECR::Repository\n"
+                          "    Properties:\n      Repositories: [1]\nTransform: ECRExpander\n"}
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as output:
+            for filename, content in templates.items():
+                with open(os.path.join(source, filename), "w") as templatefile:
+                    templatefile.write(content)
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                self.assertEqual(render.main([source, "--output", output, "--jobs", "1"]), 1)
+            self.assertEqual(os.listdir(output), ["repos.json"])
+        lines = errors.getvalue().splitlines()
+        self.assertIn("Rendered 1 of 3 templates (1 skipped, 1 failed)", lines)
+        self.assertIn("%s: not a CloudFormation template, skipped" % os.path.join(source, "config.yml"), lines)
+        self.assertTrue(any(line.startswith(os.path.join(source, "broken.yml") + ": TypeError: ") for line in lines))
+
+    def testRenderRefusesTemplatesWithTheSameOutput(self):
+        template = "Resources:\n  Bucket:\n    Type: AWS::S3::Bucket\n"
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as output:
+            for filename in ["other.yml", "stack.json", "stack.yml"]:
+                with open(os.path.join(source, filename), "w") as templatefile:
+                    templatefile.write(template)
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                self.assertEqual(render.main([source, "--output", output, "--jobs", "2"]), 1)
+            self.assertEqual(os.listdir(output), ["other.json"])
+        lines = errors.getvalue().splitlines()
+        self.assertIn("%s, %s: would all be written to %s" % (
+            os.path.join(source, "stack.json"), os.path.join(source, "stack.yml"), os.path.join(output, "stack.json")), lines)
+        self.assertIn("Rendered 1 of 3 templates (0 skipped, 2 failed)", lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
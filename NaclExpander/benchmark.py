@@ -0,0 +1,72 @@
+import sys
+import time
+import tracemalloc
+
+import macro
+
+
+def generate_fragment(nacls, rules):
+    # Every NACL gets the same rule set, split over Inbound and Outbound
+    inbound = ["%d,6,allow,10.%d.0.0/16,%d" % (100 + i, i, 1000 + i) for i in range(rules // 2)]
+    outbound = ["%d,6,allow,10.%d.0.0/16,%d-%d" % (100 + i, i, 1000 + i, 2000 + i) for i in range(rules - rules // 2)]
+    resources = {}
+    for i in range(nacls):
+        resources["Nacl%d" % i] = {
+            "Type": "AWS::EC2::NetworkAcl",
+            "Properties": {
+                "VpcId": {"Ref": "VPC"},
+                "Inbound": list(inbound),
+                "Outbound": list(outbound),
+                "Association": ["Subnet%dA" % i, "Subnet%dB" % i]
+            }
+        }
+    return {"Resources": resources}
+
+
+def shared_templates(fragment):
+    return macro.transform_resources(fragment, macro.RESOURCE_HANDLERS, {})
+
+
+def per_nacl_templates(fragment):
+    # Baseline: no rule templates are shared between NACLs and all entries are
+    # collected before they're added to the fragment
+    generated = {"Resources": {}}
+    for resource, definition in fragment['Resources'].items():
+        generated['Resources'].update((name, entry) for _, name, entry in macro.expandNacl(resource, definition, {}))
+    resources = dict(fragment['Resources'])
+    resources.update(generated['Resources'])
+    return {"Resources": resources}
+
+
+def measure(transform, fragment, runs):
+    # The transforms don't change the fragment, so it's reused for every run
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        transform(fragment)
+        timings.append(time.perf_counter() - start)
+    return min(timings), sum(timings) / runs
+
+
+def measure_peak_memory(transform, fragment):
+    # Traced separately, as tracemalloc slows down the timed runs
+    tracemalloc.start()
+    transform(fragment)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main(nacls, rules, runs):
+    fragment = generate_fragment(nacls, rules)
+    print("%d NACLs x %d rules, %d runs" % (nacls, rules, runs))
+    print("%-20s %10s %10s %12s" % ("strategy", "min ms", "avg ms", "peak KiB"))
+    for name, transform in [("per NACL", per_nacl_templates), ("shared templates", shared_templates)]:
+        best, average = measure(transform, fragment, runs)
+        peak = measure_peak_memory(transform, fragment)
+        print("%-20s %10.2f %10.2f %12.1f" % (name, best * 1000, average * 1000, peak / 1024))
+
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    main(*(arguments + [50, 40, 20][len(arguments):]))
@@ -1,107 +1,399 @@
+import copy
+import ipaddress
 import json
-import csv
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+from macrokit import instrumented, transform_resources
+
+# orjson is used for decoding embedded CloudFormation functions when it's
+# included in the package. It's only imported once it's needed, as most rules
+# don't contain any; False means it isn't available.
+ORJSON = None
+
+# A parsed "rule number,protocol,allow/deny,CIDR,ports" entry
+NaclRule = namedtuple('NaclRule', [
+    'ruleNumber', 'protocol', 'action', 'cidr', 'isIPv6', 'fromPort', 'toPort'])
+
+# Each field is either quoted with single quotes (which allows commas in
+# embedded JSON) or runs until the next comma.
+RULE_FIELD = r"(?:'([^']*)'|([^,]*))"
+RULE_PATTERN = re.compile(r",".join([RULE_FIELD] * 5) + r"$")
+
+# Properties of AWS::EC2::NetworkAcl that only exist for this macro
+MACRO_PROPERTIES = ['Inbound', 'Outbound', 'Association', 'Optimize']
+
+
+def loadJson(text):
+    global ORJSON
+    if ORJSON is None:
+        try:
+            import orjson
+            ORJSON = orjson
+        except ImportError:
+            ORJSON = False
+    if ORJSON:
+        return ORJSON.loads(text)
+    return json.loads(text)
 
 
 def isIPv6NetACL(cidr):
-    if "::/" in cidr:
-        return True
-    else:
-        return False
+    # Embedded JSON contains colons as well, so the CIDR block is parsed
+    # instead of looking for "::" (which a full IPv6 address doesn't have)
+    addresses = parseCidr(cidr)
+    if addresses is not None:
+        return addresses[0] == 6
+    return "::/" in cidr
 
 
-def createEntry(isEgress, entry, resourceName, condition):
-    # Generate entry
-    ruleNumber = entry[0]
-    protocol = entry[1]
-    action = entry[2]
-    cidr = entry[3]
-    if entry[4] == "-1":
+@lru_cache(maxsize=4096)
+def parseRule(rule):
+    # Rule sets are often repeated across NACLs, so each distinct rule string
+    # is only parsed once per container.
+    match = RULE_PATTERN.match(rule)
+    if match is None:
+        raise ValueError("Invalid NACL rule: %s" % rule)
+    groups = match.groups()
+    fields = [groups[i] if groups[i] is not None else groups[i + 1]
+              for i in range(0, len(groups), 2)]
+    ruleNumber, protocol, action, cidr, ports = fields
+    if ports == "-1":
         fromPort = "-1"
         toPort = "-1"
     else:
-        ports = entry[4].split('-')
+        ports = ports.split('-')
         fromPort = ports[0]
         toPort = ports[1] if len(ports) == 2 else ports[0]
+    isIPv6 = isIPv6NetACL(cidr)
+    if not isIPv6 and ":" in cidr:  # this means it's an object
+        cidr = loadJson(cidr)
+    return NaclRule(ruleNumber, protocol, action, cidr, isIPv6, fromPort, toPort)
 
-    generatedEntry = {
-        "Type": "AWS::EC2::NetworkAclEntry",
-        "Properties": {
-            "Egress": isEgress,
-            "NetworkAclId": {
-                "Ref": resourceName
-            },
-            "Protocol": protocol,
-            "RuleAction": action,
-            "RuleNumber": ruleNumber
-        }
-    }
-    if condition:
-        generatedEntry["Condition"] = condition
 
-    if isIPv6NetACL(cidr):
-        generatedEntry["Properties"]["Ipv6CidrBlock"] = cidr
+def createEntryTemplate(isEgress, rule, condition):
+    # Generate everything of an entry except the NACL it belongs to
+    properties = {
+        "Egress": isEgress,
+        "Protocol": rule.protocol,
+        "RuleAction": rule.action,
+        "RuleNumber": rule.ruleNumber
+    }
+    if rule.isIPv6:
+        properties["Ipv6CidrBlock"] = rule.cidr
+    elif isinstance(rule.cidr, dict):
+        # The parsed object is cached, so every template gets its own copy
+        properties["CidrBlock"] = copy.deepcopy(rule.cidr)
     else:
-        if ":" in cidr:  # this means it's an object
-            cidr = json.loads(cidr)
-        generatedEntry["Properties"]["CidrBlock"] = cidr
-    if protocol != -1:
-        generatedEntry["Properties"]["PortRange"] = {
-            "From": fromPort,
-            "To": toPort
+        properties["CidrBlock"] = rule.cidr
+    if rule.protocol != -1:
+        properties["PortRange"] = {
+            "From": rule.fromPort,
+            "To": rule.toPort
         }
+    template = {
+        "Type": "AWS::EC2::NetworkAclEntry",
+        "Properties": properties
+    }
+    if condition:
+        template["Condition"] = condition
 
     entryType = 'Outbound' if isEgress else 'Inbound'
+    return entryType + rule.ruleNumber, template
+
+
+def createEntry(isEgress, rule, resourceName, condition, templates):
+    # NACLs in a fragment often share their rules, so the entry for a rule is
+    # only built once and then stamped out for each NACL. The stamped entries
+    # share the nested values (CidrBlock, PortRange) of their template.
+    key = (isEgress, rule, condition)
+    if key not in templates:
+        templates[key] = createEntryTemplate(isEgress, parseRule(rule), condition)
+    nameSuffix, template = templates[key]
+
+    properties = dict(template["Properties"])
+    properties["NetworkAclId"] = {"Ref": resourceName}
+    generatedEntry = dict(template)
+    generatedEntry["Properties"] = properties
 
     # Generate name
-    entryName = resourceName + entryType + ruleNumber
+    entryName = resourceName + nameSuffix
     return entryName, generatedEntry
 
 
-def handler(event, context):
+@lru_cache(maxsize=4096)
+def parseCidr(cidr):
+    # Returns the IP version and the first and last address as integers, or
+    # None if the CIDR block isn't valid.
+    try:
+        network = ipaddress.ip_network(cidr, strict=False)
+    except ValueError:
+        return None
+    return network.version, int(network.network_address), int(network.broadcast_address)
+
+
+def ruleCoverage(rule):
+    # Returns the rule number, protocol, port range, and address range of a
+    # rule, or raises ValueError if any of them is invalid.
+    try:
+        ruleNumber = int(rule.ruleNumber)
+    except ValueError:
+        raise ValueError("rule number %s isn't a number" % rule.ruleNumber)
+    if rule.protocol == "-1" or rule.fromPort == "-1":
+        ports = (0, 65535)
+    else:
+        try:
+            ports = (int(rule.fromPort), int(rule.toPort))
+        except ValueError:
+            raise ValueError("rule %s has an invalid port range %s-%s" % (
+                rule.ruleNumber, rule.fromPort, rule.toPort))
+    if isinstance(rule.cidr, dict):
+        # Intrinsic functions are only resolved by CloudFormation
+        addresses = None
+    else:
+        addresses = parseCidr(rule.cidr)
+        if addresses is None:
+            raise ValueError("rule %s has an invalid CIDR block %s" % (rule.ruleNumber, rule.cidr))
+    return ruleNumber, rule.protocol, ports, addresses
+
+
+def isShadowedBy(rule, earlier):
+    # A rule is never evaluated if an earlier rule matches all of its traffic
+    _, protocol, ports, addresses = rule
+    _, earlierProtocol, earlierPorts, earlierAddresses = earlier
+    if earlierProtocol != "-1" and earlierProtocol != protocol:
+        return False
+    if earlierPorts[0] > ports[0] or earlierPorts[1] < ports[1]:
+        return False
+    if addresses is None or earlierAddresses is None or earlierAddresses[0] != addresses[0]:
+        return False
+    return earlierAddresses[1] <= addresses[1] and earlierAddresses[2] >= addresses[2]
+
+
+def ruleLimit():
+    # The default quota for rules per direction of a NACL, which can be raised
+    return int(os.environ.get('NACL_RULE_LIMIT', '20'))
+
+
+@lru_cache(maxsize=1024)
+def validateRules(rules, limit):
+    # Checks the rules of one direction of a NACL. Returns the errors, the
+    # warnings, and the rule numbers that get an entry. NACLs often share
+    # their rules, so each distinct set is only checked once per container.
+    errors = []
+    warnings = []
+    parsedRules = []
+    for rule in rules:
+        try:
+            parsedRule = parseRule(rule)
+            parsedRules.append((ruleCoverage(parsedRule), parsedRule))
+        except ValueError as error:
+            errors.append(str(error))
+    if len(parsedRules) > limit:
+        errors.append("%d rules exceeds the limit of %d" % (len(parsedRules), limit))
+    # Sorting by rule number puts collisions next to each other and the rules
+    # in the order AWS evaluates them
+    parsedRules.sort(key=lambda rule: rule[0][0])
+    ruleNumbers = []
+    for index, (coverage, parsedRule) in enumerate(parsedRules):
+        if coverage[0] < 1 or coverage[0] > 32766:
+            errors.append("rule number %d must be between 1 and 32766" % coverage[0])
+        if index > 0 and parsedRules[index - 1][0][0] == coverage[0]:
+            errors.append("rule number %d is used more than once" % coverage[0])
+            continue
+        ruleNumbers.append(parsedRule.ruleNumber)
+        for earlier, _ in parsedRules[:index]:
+            if earlier[0] < coverage[0] and isShadowedBy(coverage, earlier):
+                warnings.append("rule %d is shadowed by rule %d" % (coverage[0], earlier[0]))
+                break
+    return tuple(errors), tuple(warnings), tuple(ruleNumbers)
+
+
+def validateNacls(fragment):
+    # Checks the rules of all NACLs in the fragment before anything is
+    # generated. Returns a list of errors and a list of warnings.
+    errors = []
+    warnings = []
+    limit = ruleLimit()
+    generatedNames = set()
+
+    def addGeneratedName(resource, entryName):
+        if entryName in fragment['Resources'] or entryName in generatedNames:
+            errors.append("%s: generated resource %s already exists" % (resource, entryName))
+        generatedNames.add(entryName)
+
+    for resource, definition in fragment['Resources'].items():
+        if definition.get('Type') != 'AWS::EC2::NetworkAcl':
+            continue
+        properties = definition.get('Properties', {})
+        for entryType in ['Inbound', 'Outbound']:
+            ruleErrors, ruleWarnings, ruleNumbers = validateRules(tuple(naclRules(properties, entryType)), limit)
+            errors.extend("%s %s: %s" % (resource, entryType, error) for error in ruleErrors)
+            for ruleNumber in ruleNumbers:
+                addGeneratedName(resource, resource + entryType + ruleNumber)
+            warnings.extend("%s %s: %s" % (resource, entryType, warning) for warning in ruleWarnings)
+        for assoc in properties.get('Association', []):
+            addGeneratedName(resource, assoc + resource)
+    return errors, warnings
+
+
+def portField(rule):
+    if rule.fromPort == "-1":
+        return "-1"
+    if rule.fromPort == rule.toPort:
+        return rule.fromPort
+    return rule.fromPort + "-" + rule.toPort
+
+
+def mergeRules(first, second):
+    # Merges two rules that are next to each other in evaluation order into a
+    # single rule that matches the traffic of both, or returns None if that
+    # isn't possible. As no other rule is evaluated between the two, the
+    # merged rule can take the place of the first one.
+    firstNumber, firstRule, firstPorts, firstNetwork, _ = first
+    _, secondRule, secondPorts, secondNetwork, _ = second
+    if firstRule.protocol != secondRule.protocol or firstRule.action != secondRule.action:
+        return None
+    if firstNetwork.version != secondNetwork.version:
+        return None
+    network = None
+    ports = portField(firstRule)
+    if firstPorts == secondPorts or firstRule.protocol == "-1":
+        if secondNetwork.subnet_of(firstNetwork):
+            network = firstNetwork
+        elif firstNetwork.subnet_of(secondNetwork):
+            network = secondNetwork
+        elif firstNetwork.prefixlen == secondNetwork.prefixlen and firstNetwork.supernet() == secondNetwork.supernet():
+            network = firstNetwork.supernet()
+    elif firstNetwork == secondNetwork:
+        if firstPorts[0] > secondPorts[1] + 1 or secondPorts[0] > firstPorts[1] + 1:
+            return None
+        network = firstNetwork
+        mergedPorts = (min(firstPorts[0], secondPorts[0]), max(firstPorts[1], secondPorts[1]))
+        if mergedPorts == secondPorts:
+            ports = portField(secondRule)
+        elif mergedPorts != firstPorts:
+            ports = "%d-%d" % mergedPorts
+    if network is None:
+        return None
+    if network == firstNetwork:
+        cidr = firstRule.cidr
+    elif network == secondNetwork:
+        cidr = secondRule.cidr
+    else:
+        cidr = str(network)
+    rule = ",".join([firstRule.ruleNumber, firstRule.protocol, firstRule.action, cidr, ports])
+    parsedRule = parseRule(rule)
+    return firstNumber, parsedRule, ruleCoverage(parsedRule)[2], network, rule
+
+
+@lru_cache(maxsize=1024)
+def optimizeRules(rules):
+    # Merges rules with the same protocol and action that are next to each
+    # other in evaluation order, where either their CIDR blocks or their port
+    # ranges can be combined. Rule sets that can't be fully parsed, or that use
+    # CloudFormation functions, are returned unchanged.
+    entries = []
+    for rule in rules:
+        try:
+            parsedRule = parseRule(rule)
+            number, _, ports, addresses = ruleCoverage(parsedRule)
+        except ValueError:
+            return rules
+        if addresses is None:
+            return rules
+        network = ipaddress.ip_network(parsedRule.cidr, strict=False)
+        entries.append((number, parsedRule, ports, network, rule))
+    entries.sort(key=lambda entry: entry[0])
+    if len(set(entry[0] for entry in entries)) != len(entries):
+        return rules
+    index = 0
+    while index < len(entries) - 1:
+        merged = mergeRules(entries[index], entries[index + 1])
+        if merged is None:
+            index += 1
+        else:
+            entries[index:index + 2] = [merged]
+            # The merged rule may now combine with the one before it
+            index = max(index - 1, 0)
+    return tuple(entry[4] for entry in entries)
+
+
+def naclRules(properties, entryType):
+    # The rules of a direction, optimized if the NACL asks for it
+    rules = properties.get(entryType, [])
+    if properties.get('Optimize') in [True, "true", "True"]:
+        return list(optimizeRules(tuple(rules)))
+    return rules
+
+
+def expandNacl(resource, definition, templates):
+    # Entries are yielded one at a time, so they're added to the fragment
+    # without first collecting them all.
+    properties = definition['Properties']
+    condition = definition.get('Condition', '')
+    if any(key in properties for key in MACRO_PROPERTIES):
+        # Replace the NACL with a copy without the macro's properties
+        nacl = dict(definition)
+        nacl['Properties'] = dict((key, value) for key, value in properties.items()
+                                  if key not in MACRO_PROPERTIES)
+        yield "Resources", resource, nacl
+    else:
+        yield "Resources", resource, definition
+    for rule in naclRules(properties, 'Inbound'):
+        entryName, entry = createEntry(False, rule, resource, condition, templates)
+        yield "Resources", entryName, entry
+    for rule in naclRules(properties, 'Outbound'):
+        entryName, entry = createEntry(True, rule, resource, condition, templates)
+        yield "Resources", entryName, entry
+    for assoc in properties.get('Association', []):
+        generatedAssoc = {
+            "Type": "AWS::EC2::SubnetNetworkAclAssociation",
+            "Properties": {
+                "SubnetId": {"Ref": assoc},
+                "NetworkAclId": {"Ref": resource}
+            }
+        }
+        if condition:
+            generatedAssoc["Condition"] = condition
+        entryName = assoc + resource
+        yield "Resources", entryName, generatedAssoc
+
+
+# Handlers per resource Type for macrokit.transform_resources. Each receives
+# the logical ID, the resource definition and the entry templates built for
+# this fragment.
+RESOURCE_HANDLERS = {
+    'AWS::EC2::NetworkAcl': expandNacl
+}
+
+
+@instrumented("NaclExpander")
+def handler(event, context, metrics):
     macro_response = {
         "requestId": event["requestId"],
         "status": "success"
     }
     # Globals
     fragment = event['fragment']
-    result = fragment
+    # Rules that were already parsed by an earlier invocation are cache hits
+    parsed = parseRule.cache_info()
 
-    for resource in list(fragment["Resources"].keys()):
-        if "Condition" in fragment["Resources"][resource]:
-            condition = fragment["Resources"][resource]["Condition"]
-        else:
-            condition = ''
-        if fragment['Resources'][resource]['Type'] == 'AWS::EC2::NetworkAcl':
-            if "Inbound" in fragment['Resources'][resource]['Properties']:
-                entries = csv.reader(
-                    fragment['Resources'][resource]['Properties']['Inbound'], delimiter=',', quotechar="'")
-                for entry in entries:
-                    entryName, generatedEntry = createEntry(
-                        False, entry, resource, condition)
-                    result['Resources'][entryName] = generatedEntry
-                result['Resources'][resource]['Properties'].pop('Inbound')
-            if "Outbound" in fragment['Resources'][resource]['Properties']:
-                entries = csv.reader(
-                    fragment['Resources'][resource]['Properties']['Outbound'], delimiter=',', quotechar="'")
-                for entry in entries:
-                    entryName, generatedEntry = createEntry(
-                        True, entry, resource, condition)
-                    result['Resources'][entryName] = generatedEntry
-                result['Resources'][resource]['Properties'].pop('Outbound')
-            if "Association" in fragment['Resources'][resource]['Properties']:
-                for assoc in fragment['Resources'][resource]['Properties']['Association']:
-                    generatedAssoc = {
-                        "Type": "AWS::EC2::SubnetNetworkAclAssociation",
-                        "Properties": {
-                            "SubnetId": {"Ref": assoc},
-                            "NetworkAclId": {"Ref": resource}
-                        }
-                    }
-                    if condition:
-                        generatedAssoc["Condition"] = condition
-                    entryName = assoc + resource
-                    result['Resources'][entryName] = generatedAssoc
-                result['Resources'][resource]['Properties'].pop('Association')
+    with metrics.phase("Parse"):
+        errors, warnings = validateNacls(fragment)
+    metrics.add("Warnings", len(warnings))
+    for warning in warnings:
+        print("WARNING: %s" % warning)
+    if errors:
+        macro_response['status'] = "failure"
+        macro_response['errorMessage'] = "; ".join(errors)
+        return macro_response
+
+    with metrics.phase("Expand"):
+        result = transform_resources(fragment, RESOURCE_HANDLERS, {})
+    metrics.add("RuleCacheHits", parseRule.cache_info().hits - parsed.hits)
+    metrics.add("RuleCacheMisses", parseRule.cache_info().misses - parsed.misses)
 
     macro_response['fragment'] = result
     return macro_response
@@ -1,4 +1,8 @@
+import contextlib
+import io
 import macro
+import mock
+import os
 import json
 import unittest
 
@@ -447,6 +451,250 @@ class TestStringMethods(unittest.TestCase):
         self.assertRaises(KeyError, lambda: fragment["Resources"]["NaclPublic"]["Outbound"])
         self.assertRaises(KeyError, lambda: fragment["Resources"]["NaclPublic"]["Inbound"])
 
+    def testParseRuleWithQuotedObject(self):
+        rule = macro.parseRule("200,6,deny,'{ \"Fn::GetAtt\" : [ \"VPC\", \"CidrBlock\" ] }',22-52")
+        self.assertEqual(rule.ruleNumber, "200")
+        self.assertEqual(rule.protocol, "6")
+        self.assertEqual(rule.action, "deny")
+        self.assertEqual(rule.cidr, {"Fn::GetAtt": ["VPC", "CidrBlock"]})
+        self.assertEqual(rule.isIPv6, False)
+        self.assertEqual(rule.fromPort, "22")
+        self.assertEqual(rule.toPort, "52")
+
+    def testParseRuleIsCached(self):
+        first = macro.parseRule("100,6,allow,0.0.0.0/0,443")
+        second = macro.parseRule("100,6,allow,0.0.0.0/0,443")
+        self.assertIs(first, second)
+
+    def testParseRuleInvalid(self):
+        self.assertRaises(ValueError, lambda: macro.parseRule("100,6,allow,0.0.0.0/0"))
+
+    def testParseRuleFullIPv6(self):
+        rule = macro.parseRule("100,6,allow,2001:db8:1:2:3:4:5:0/112,443")
+        self.assertEqual(rule.cidr, "2001:db8:1:2:3:4:5:0/112")
+        self.assertEqual(rule.isIPv6, True)
+
+    def testRepeatedObjectRulesAreNotSharedBetweenFragments(self):
+        rule = "100,6,allow,'{ \"Fn::GetAtt\" : [ \"VPC\", \"CidrBlock\" ] }',443"
+        cidrs = []
+        for _ in range(2):
+            event = {}
+            event["region"] = "ap-southeast-2"
+            event["requestId"] = "testRequest"
+            event["fragment"] = {"Resources": {
+                "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": [rule]}}}}
+            result = macro.handler(event, None)
+            cidrs.append(result["fragment"]["Resources"]["NaclPublicInbound100"]["Properties"]["CidrBlock"])
+        self.assertEqual(cidrs[0], cidrs[1])
+        self.assertIsNot(cidrs[0], cidrs[1])
+
+    def testIdenticalRulesAcrossNacls(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/0,443"]}},
+            "NaclPrivate": {"Type": "AWS::EC2::NetworkAcl", "Condition": "HasPrivate", "Properties": {"Inbound": ["100,6,allow,0.0.0.0/0,443"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        public_entry = fragment["Resources"]["NaclPublicInbound100"]
+        private_entry = fragment["Resources"]["NaclPrivateInbound100"]
+        self.assertEqual(public_entry["Properties"]["NetworkAclId"], {"Ref": "NaclPublic"})
+        self.assertEqual(private_entry["Properties"]["NetworkAclId"], {"Ref": "NaclPrivate"})
+        self.assertEqual(private_entry["Condition"], "HasPrivate")
+        self.assertRaises(KeyError, lambda: public_entry["Condition"])
+        self.assertEqual(public_entry["Properties"]["PortRange"], private_entry["Properties"]["PortRange"])
+
+    def testNaclInvalidCidrFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,10.0.0.0/33,443"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "NaclPublic Inbound: rule 100 has an invalid CIDR block 10.0.0.0/33")
+
+    def testNaclInvalidPortRangeFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {"Outbound": ["100,6,allow,0.0.0.0/0,https"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "NaclPublic Outbound: rule 100 has an invalid port range https-https")
+
+    def testShadowedRulesAreDetected(self):
+        fragment = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "Inbound": [
+                    "200,6,allow,10.1.0.0/16,443",
+                    "100,6,deny,10.0.0.0/8,400-500",
+                    "300,17,allow,10.1.0.0/16,443",
+                    "400,-1,allow,0.0.0.0/0,-1",
+                    "500,17,allow,10.2.0.0/16,53"],
+                "Outbound": [
+                    "100,6,allow,10.0.0.0/8,443",
+                    "200,6,allow,0.0.0.0/0,443",
+                    "300,6,allow,2406:da1c:a9e:b901::/64,443"]}}}}
+        errors, warnings = macro.validateNacls(fragment)
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, [
+            "NaclPublic Inbound: rule 200 is shadowed by rule 100",
+            "NaclPublic Inbound: rule 500 is shadowed by rule 400"])
+
+    def testDuplicateRuleNumberFails(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "Inbound": ["100,6,allow,0.0.0.0/0,443", "100,6,allow,0.0.0.0/0,80"],
+                "Outbound": ["100,6,allow,0.0.0.0/0,443"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "NaclPublic Inbound: rule number 100 is used more than once")
+
+    def testRuleNumberOutOfRangeFails(self):
+        fragment = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["32767,6,allow,0.0.0.0/0,443"]}}}}
+        errors, _ = macro.validateNacls(fragment)
+        self.assertEqual(errors, ["NaclPublic Inbound: rule number 32767 must be between 1 and 32766"])
+
+    @mock.patch.dict(os.environ, {"NACL_RULE_LIMIT": "2"})
+    def testRuleLimitExceededFails(self):
+        fragment = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "Inbound": ["100,6,allow,0.0.0.0/0,443", "110,6,allow,0.0.0.0/0,80"],
+                "Outbound": ["100,6,allow,0.0.0.0/0,443", "110,6,allow,0.0.0.0/0,80", "120,6,allow,0.0.0.0/0,22"]}}}}
+        errors, _ = macro.validateNacls(fragment)
+        self.assertEqual(errors, ["NaclPublic Outbound: 3 rules exceeds the limit of 2"])
+
+    def testGeneratedNameClashFails(self):
+        fragment = {"Resources": {
+            "NaclPublicInbound100": {"Type": "AWS::S3::Bucket"},
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "Inbound": ["100,6,allow,0.0.0.0/0,443"], "Association": ["SubnetA"]}},
+            "SubnetANaclPublic": {"Type": "AWS::S3::Bucket"}}}
+        errors, _ = macro.validateNacls(fragment)
+        self.assertEqual(errors, [
+            "NaclPublic: generated resource NaclPublicInbound100 already exists",
+            "NaclPublic: generated resource SubnetANaclPublic already exists"])
+
+    def testValidationIsSharedByNacls(self):
+        rules = ["100,6,allow,0.0.0.0/0,443", "200,6,allow,10.0.0.0/8,443"]
+        fragment = {"Resources": {
+            "NaclPublic": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": rules}},
+            "NaclPrivate": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": rules}}}}
+        validated = macro.validateRules.cache_info()
+        errors, warnings = macro.validateNacls(fragment)
+        self.assertEqual(errors, [])
+        self.assertEqual(warnings, [
+            "NaclPublic Inbound: rule 200 is shadowed by rule 100",
+            "NaclPrivate Inbound: rule 200 is shadowed by rule 100"])
+        self.assertGreaterEqual(macro.validateRules.cache_info().hits - validated.hits, 1)
+
+    def testFullIPv6CidrBlock(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["100,6,allow,2001:db8:1:2:3:4:5:0/112,443"]}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "success")
+        properties = result["fragment"]["Resources"]["NaclPublicInbound100"]["Properties"]
+        self.assertEqual(properties["Ipv6CidrBlock"], "2001:db8:1:2:3:4:5:0/112")
+        self.assertNotIn("CidrBlock", properties)
+
+    def testOptimizeMergesRules(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "Optimize": True,
+                "Inbound": [
+                    "100,6,allow,10.0.0.0/24,443",
+                    "110,6,allow,10.0.1.0/24,443",
+                    "120,6,allow,0.0.0.0/0,80",
+                    "130,6,allow,0.0.0.0/0,81-90",
+                    "140,6,deny,0.0.0.0/0,91"]}}}}
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        expected_resources = ["NaclPublic", "NaclPublicInbound100", "NaclPublicInbound120", "NaclPublicInbound140"]
+        expected_resources.sort()
+        actual_resources = list(fragment["Resources"].keys())
+        actual_resources.sort()
+        self.assertEqual(expected_resources, actual_resources)
+        self.assertEqual(fragment["Resources"]["NaclPublicInbound100"]["Properties"]["CidrBlock"], "10.0.0.0/23")
+        self.assertEqual(fragment["Resources"]["NaclPublicInbound120"]["Properties"]["PortRange"], {"From": "80", "To": "90"})
+        self.assertRaises(KeyError, lambda: fragment["Resources"]["NaclPublic"]["Properties"]["Optimize"])
+
+    def testOptimizeKeepsEvaluationOrder(self):
+        rules = (
+            "100,6,allow,10.0.0.0/24,443",
+            "110,6,deny,10.0.1.0/24,443",
+            "120,6,allow,10.0.1.0/24,443")
+        self.assertEqual(macro.optimizeRules(rules), rules)
+
+    def testOptimizeDropsContainedRules(self):
+        rules = (
+            "100,-1,allow,10.0.0.0/16,-1",
+            "110,-1,allow,10.0.5.0/24,-1")
+        self.assertEqual(macro.optimizeRules(rules), ("100,-1,allow,10.0.0.0/16,-1",))
+
+    def testOptimizeIgnoresRulesWithFunctions(self):
+        rules = (
+            "100,6,allow,10.0.0.0/24,443",
+            "110,6,allow,10.0.1.0/24,443",
+            "120,6,allow,'{ \"Fn::GetAtt\" : [ \"VPC\", \"CidrBlock\" ] }',443")
+        self.assertEqual(macro.optimizeRules(rules), rules)
+
+    def testNotOptimizedByDefault(self):
+        properties = {"Inbound": ["100,6,allow,10.0.0.0/24,443", "110,6,allow,10.0.1.0/24,443"]}
+        self.assertEqual(macro.naclRules(properties, "Inbound"), properties["Inbound"])
+
+    def testFragmentIsNotChanged(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"NaclPublic": {
+            "Type": "AWS::EC2::NetworkAcl", "Properties": {
+                "VpcId": {"Ref": "VPC"},
+                "Inbound": ["100,6,allow,0.0.0.0/0,443"],
+                "Association": ["SubnetA"]}}}}
+        original = json.dumps(event["fragment"])
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertEqual(json.dumps(event["fragment"]), original)
+        self.assertEqual(fragment["Resources"]["NaclPublic"]["Properties"], {"VpcId": {"Ref": "VPC"}})
+        self.assertIs(fragment["Resources"]["NaclPublic"]["Properties"]["VpcId"],
+                      event["fragment"]["Resources"]["NaclPublic"]["Properties"]["VpcId"])
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsLoggedAsEMF(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "NaclFirst": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["107,6,allow,10.7.0.0/16,443"]}},
+            "NaclSecond": {"Type": "AWS::EC2::NetworkAcl", "Properties": {"Inbound": ["107,6,allow,10.7.0.0/16,443"]}}}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(event, None)
+        metrics, = [json.loads(line) for line in output.getvalue().splitlines() if line.startswith('{"_aws"')]
+        names = [metric["Name"] for metric in metrics["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+        self.assertEqual(metrics["Macro"], "NaclExpander")
+        self.assertEqual((metrics["ResourcesIn"], metrics["ResourcesOut"]), (2, 4))
+        # The rule is parsed once when the rules are validated, which the
+        # other NACL shares, and found in the cache when its entries are
+        # generated
+        self.assertEqual((metrics["RuleCacheHits"], metrics["RuleCacheMisses"]), (1, 1))
+        self.assertAlmostEqual(metrics["RuleCacheHitRate"], 50.0)
+        for name in ["ParseTime", "ExpandTime", "InvocationTime"]:
+            self.assertIn(name, names)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,174 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import macro
+
+# Every scenario runs in a fresh interpreter so the import is a real cold import.
+# The lookup table is served by moto, so no AWS account is needed.
+SCENARIO = """
+import json
+import time
+start = time.perf_counter()
+import macro
+imported = time.perf_counter()
+lookups = %(lookups)s
+if lookups:
+    from moto import mock_s3
+    mock = mock_s3()
+    mock.start()
+    import boto3
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='benchbucket')
+    s3.put_object(Bucket='benchbucket', Key='lookuptable.json', Body=json.dumps({"My Name": "abcdef-123456"}))
+def event():
+    return {
+        "requestId": "benchmark",
+        "region": "us-east-1",
+        "fragment": {"Resources": {"Assmnt": {
+            "Type": "AWS::SSO::Assignment", "Properties": {"PrincipalName": "My Name"}}}}
+    }
+called = time.perf_counter()
+macro.handler(event(), None)
+first = time.perf_counter()
+macro.handler(event(), None)
+second = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "first_call": first - called,
+    "second_call": second - first
+}))
+"""
+
+
+def run_scenario(lookups, cachedir):
+    env = dict(os.environ)
+    env['LOOKUPTABLE_CACHE_DIR'] = cachedir
+    env['AWS_ACCESS_KEY_ID'] = 'testing'
+    env['AWS_SECRET_ACCESS_KEY'] = 'testing'
+    env['AWS_DEFAULT_REGION'] = 'us-east-1'
+    if lookups:
+        env['BUCKET_NAME'] = 'benchbucket'
+        env['LOOKUPTABLE_PREFIX'] = 'lookuptable.json'
+    else:
+        env['BUCKET_NAME'] = ''
+        env['LOOKUPTABLE_PREFIX'] = ''
+    output = subprocess.check_output(
+        [sys.executable, '-c', SCENARIO % {"lookups": lookups}],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def startup(runs):
+    print("%-16s %12s %12s %12s" % ("scenario", "import ms", "first ms", "second ms"))
+    for name, lookups, diskcache in [("without lookups", False, False), ("with lookups", True, False),
+                                     ("with disk cache", True, True)]:
+        with tempfile.TemporaryDirectory() as cachedir:
+            if diskcache:
+                # Leave the table in /tmp, like an earlier execution environment would
+                run_scenario(lookups, cachedir)
+                results = [run_scenario(lookups, cachedir) for _ in range(runs)]
+            else:
+                results = []
+                for _ in range(runs):
+                    with tempfile.TemporaryDirectory() as runcachedir:
+                        results.append(run_scenario(lookups, runcachedir))
+        averages = {}
+        for measurement in ["import", "first_call", "second_call"]:
+            averages[measurement] = sum(r[measurement] for r in results) / runs * 1000
+        print("%-16s %12.2f %12.2f %12.2f" % (
+            name, averages["import"], averages["first_call"], averages["second_call"]))
+
+
+def generate_fragment(permission_sets, statements):
+    resources = {}
+    for i in range(permission_sets):
+        resources["PermSet%d" % i] = {
+            "Type": "AWS::SSO::PermissionSet",
+            "Properties": {
+                "Name": "PermissionSet%d" % i,
+                "PolicyDocument": {
+                    "Version": "2012-10-17",
+                    "Statement": [{
+                        "Sid": "Statement%d" % j,
+                        "Effect": "Allow",
+                        "Action": ["s3:GetObject", "s3:PutObject", "s3:ListBucket", "s3:DeleteObject"],
+                        "Resource": ["arn:aws:s3:::bucket-%d-%d" % (i, j), "arn:aws:s3:::bucket-%d-%d/*" % (i, j)],
+                        "Condition": {"StringEquals": {"aws:PrincipalTag/Team": "team-%d" % j}}
+                    } for j in range(statements)]
+                }
+            }
+        }
+    return {"Resources": resources}
+
+
+def policies(permission_sets, statements, runs):
+    # Compares the serialisers on the PolicyDocument to InlinePolicy conversion
+    fragment = generate_fragment(permission_sets, statements)
+    serialisers = [("json", False)]
+    if macro.get_orjson():
+        serialisers.append(("orjson", macro.get_orjson()))
+    else:
+        print("orjson isn't installed, only measuring json")
+    print("%d permission sets x %d statements, %d runs" % (permission_sets, statements, runs))
+    print("%-10s %10s %10s" % ("serialiser", "min ms", "avg ms"))
+    for name, serialiser in serialisers:
+        timings = []
+        with mock.patch.object(macro, "ORJSON", serialiser):
+            for _ in range(runs):
+                start = time.perf_counter()
+                macro.transform_resources(fragment, macro.RESOURCE_HANDLERS, None)
+                timings.append(time.perf_counter() - start)
+        print("%-10s %10.2f %10.2f" % (name, min(timings) * 1000, sum(timings) / runs * 1000))
+
+
+class LocalS3Client:
+    def __init__(self, content):
+        self.content = content
+
+    def get_object(self, **kwargs):
+        return {"Body": io.BytesIO(self.content), "ETag": "\"benchmark\""}
+
+
+def lookups(principals, assignments, runs):
+    # Compares loading a lookup table and resolving a few names from it, for
+    # the JSON and the sorted index formats
+    table = dict(("User %07d" % i, "id-%07d" % i) for i in range(principals))
+    names = set(("USER", "User %07d" % (i * principals // assignments)) for i in range(assignments))
+    formats = [
+        ("json", "lookuptable.json", json.dumps(table).encode('utf-8')),
+        ("index", "lookuptable.tsv", macro.build_lookup_index(table))
+    ]
+    print("%d principals, %d assignments, %d runs" % (principals, assignments, runs))
+    print("%-10s %10s %10s %10s" % ("format", "size KiB", "min ms", "avg ms"))
+    for name, key, content in formats:
+        s3client = LocalS3Client(content)
+        timings = []
+        for _ in range(runs):
+            # Every run starts without a cached table, in memory or on disk
+            macro.LOOKUP_CACHE.clear()
+            with tempfile.TemporaryDirectory() as cachedir:
+                os.environ['LOOKUPTABLE_CACHE_DIR'] = cachedir
+                with contextlib.redirect_stdout(io.StringIO()):
+                    metrics = macro.Metrics("SSOFixer")
+                    start = time.perf_counter()
+                    macro.resolve_principals(names, None, "", lambda: macro.get_lookup_table(s3client, "benchbucket", key, metrics), metrics)
+                    timings.append(time.perf_counter() - start)
+        print("%-10s %10d %10.2f %10.2f" % (
+                name, len(content) / 1024, min(timings) * 1000, sum(timings) / runs * 1000))
+
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[2:]]
+    if len(sys.argv) > 1 and sys.argv[1] == "policies":
+        policies(*(arguments + [200, 20, 20][len(arguments):]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "lookups":
+        lookups(*(arguments + [50000, 20, 10][len(arguments):]))
+    else:
+        startup(*(arguments + [5][len(arguments):]))
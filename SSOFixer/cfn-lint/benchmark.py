@@ -0,0 +1,68 @@
+import json
+import os
+import sys
+import tempfile
+import time
+
+import cfnlint.core
+import cfnlint.decode
+from cfnlint.rules import RulesCollection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules'))
+import SSOPolicy  # noqa: E402
+
+# Runs only the SSOPolicy rule over a generated template, so the time isn't
+# dominated by the default cfn-lint rules. Half of the permission sets have
+# their policy as a JSON string, which is how SSOFixer templates often share
+# a single policy.
+
+
+def generate_template(permission_sets, statements):
+    policy = {
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Sid": "Statement%d" % j,
+            "Effect": "Allow",
+            "Action": ["s3:GetObject", "s3:PutObject", "s3:ListBucket"],
+            "Resource": ["arn:aws:s3:::bucket-%d" % j, "arn:aws:s3:::bucket-%d/*" % j]
+        } for j in range(statements)]
+    }
+    resources = {}
+    for i in range(permission_sets):
+        resources["PermSet%d" % i] = {
+            "Type": "AWS::SSO::PermissionSet",
+            "Properties": {
+                "Name": "PermissionSet%d" % i,
+                "InstanceArn": "arn:aws:sso:::instance/ssoins-1234567890abcdef",
+                "PolicyDocument": json.dumps(policy) if i % 2 else policy
+            }
+        }
+    return {"AWSTemplateFormatVersion": "2010-09-09", "Resources": resources}
+
+
+def run(permission_sets, statements, runs):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as templatefile:
+        json.dump(generate_template(permission_sets, statements), templatefile)
+    try:
+        template, _ = cfnlint.decode.decode(templatefile.name)
+        timings = []
+        for _ in range(runs):
+            # A new rule every run, and the action catalogue and checked
+            # actions are cleared, so nothing is cached yet
+            SSOPolicy.ACTION_CATALOGUE = None
+            SSOPolicy.check_action.cache_clear()
+            rules = RulesCollection()
+            rules.register(SSOPolicy.SSOPolicy())
+            start = time.perf_counter()
+            matches = cfnlint.core.run_checks(templatefile.name, template, rules, ['us-east-1'])
+            timings.append(time.perf_counter() - start)
+    finally:
+        os.remove(templatefile.name)
+    print("%d permission sets x %d statements, %d runs, %d matches" % (permission_sets, statements, runs, len(matches)))
+    print("%10s %10s" % ("min ms", "avg ms"))
+    print("%10.2f %10.2f" % (min(timings) * 1000, sum(timings) / runs * 1000))
+
+
+if __name__ == '__main__':
+    arguments = [int(argument) for argument in sys.argv[1:]]
+    run(*(arguments + [500, 10, 5][len(arguments):]))
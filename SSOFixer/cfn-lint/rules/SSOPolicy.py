@@ -3,14 +3,117 @@ Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
 SPDX-License-Identifier: MIT-0
 Copied and adapted from https://github.com/aws-cloudformation/cfn-python-lint/blob/master/src/cfnlint/rules/resources/iam/Policy.py
 """
+import fnmatch
 import json
 from datetime import date
+from functools import lru_cache
 import six
-from cfnlint.helpers import convert_dict
+from cfnlint.data import AdditionalSpecs
+from cfnlint.helpers import convert_dict, load_resource
 from cfnlint.rules import CloudFormationLintRule
 from cfnlint.rules import RuleMatch
 
 
+# Everything the checks compare against is built once, when the rule is loaded
+POLICY_KEYS = frozenset([
+    'Version',
+    'Id',
+    'Statement',
+])
+POLICY_VERSIONS = frozenset(['2012-10-17', '2008-10-17', date(2012, 10, 17), date(2008, 10, 17)])
+STATEMENT_KEYS = frozenset([
+    'Action',
+    'Condition',
+    'Effect',
+    'NotAction',
+    'NotPrincipal',
+    'NotResource',
+    'Principal',
+    'Resource',
+    'Sid',
+])
+EFFECTS = frozenset(['Allow', 'Deny'])
+POLICY_PROPERTIES = frozenset(['KeyPolicy', 'PolicyDocument', 'RepositoryPolicyText', 'AccessPolicies'])
+ACTION_KEYS = frozenset(['Action', 'NotAction'])
+
+# The IAM actions of every service, from the policy data that comes with
+# cfn-lint. Loaded the first time it's needed, and then kept for the rest of
+# the lint run.
+ACTION_CATALOGUE = None
+
+
+def action_catalogue():
+    """A trie of the (lower case) actions per (lower case) service prefix.
+    Each node is a dict by character, the empty string marks an action."""
+    global ACTION_CATALOGUE
+    if ACTION_CATALOGUE is None:
+        catalogue = {}
+        for properties in load_resource(AdditionalSpecs, 'Policies.json')['serviceMap'].values():
+            # Some services share their prefix, like elasticloadbalancing
+            trie = catalogue.setdefault(properties['StringPrefix'].lower(), {})
+            for action in properties['Actions']:
+                node = trie
+                for character in action.lower():
+                    node = node.setdefault(character, {})
+                node[''] = True
+        ACTION_CATALOGUE = catalogue
+    return ACTION_CATALOGUE
+
+
+def trie_matches(trie, pattern):
+    """Whether any action in the trie matches the pattern, which can have * and ? wildcards"""
+    if '*' not in pattern and '?' not in pattern:
+        node = trie
+        for character in pattern:
+            node = node.get(character)
+            if node is None:
+                return False
+        return '' in node
+    stack = [(trie, 0)]
+    seen = set()
+    while stack:
+        node, index = stack.pop()
+        if (id(node), index) in seen:
+            continue
+        seen.add((id(node), index))
+        if index == len(pattern):
+            if '' in node:
+                return True
+            continue
+        character = pattern[index]
+        if character == '*':
+            if index == len(pattern) - 1:
+                # Every node leads to at least one action
+                return True
+            stack.append((node, index + 1))
+            stack.extend((child, index) for key, child in node.items() if key != '')
+        elif character == '?':
+            stack.extend((child, index + 1) for key, child in node.items() if key != '')
+        elif character in node:
+            stack.append((node[character], index + 1))
+    return False
+
+
+@lru_cache(maxsize=4096)
+def check_action(action):
+    """The problem with an action, or None if it exists"""
+    if action == '*':
+        return None
+    service, separator, name = action.lower().partition(':')
+    if not separator or not service or not name:
+        return 'IAM Policy action %s should be in the format service:action' % (action)
+    catalogue = action_catalogue()
+    if '*' in service or '?' in service:
+        services = [catalogue[prefix] for prefix in fnmatch.filter(catalogue, service)]
+    elif service in catalogue:
+        services = [catalogue[service]]
+    else:
+        return 'IAM Policy action %s has an unknown service %s' % (action, service)
+    if not any(trie_matches(trie, name) for trie in services):
+        if '*' in action or '?' in action:
+            return 'IAM Policy action %s doesn\'t match any actions' % (action)
+        return 'IAM Policy action %s doesn\'t exist' % (action)
+    return None
 
 
 class SSOPolicy(CloudFormationLintRule):
@@ -31,155 +134,130 @@ class SSOPolicy(CloudFormationLintRule):
         self.idp_and_keys = {
             'AWS::SSO::PermissionSet': 'PolicyDocument',
         }
-        for resource_type in self.resources_and_keys:
-            self.resource_property_types.append(resource_type)
-        for resource_type in self.idp_and_keys:
+        self.config_definition = {
+            'actions': {
+                'default': True,
+                'type': 'boolean',
+            },
+        }
+        self.configure()
+        # Per resource type: whether it has an identity policy and whether
+        # statements may leave out the Resource
+        self.resource_checks = {}
+        for resource_type, key in self.resources_and_keys.items():
+            self.resource_checks[resource_type] = (False, key == self.resource_exceptions.get(resource_type))
+        for resource_type, key in self.idp_and_keys.items():
+            self.resource_checks[resource_type] = (True, key == self.resource_exceptions.get(resource_type))
+        for resource_type in self.resource_checks:
             self.resource_property_types.append(resource_type)
+        # The findings for policies given as a JSON string, so a policy that's
+        # used by many permission sets is only parsed and checked once
+        self.string_policies = {}
 
     def check_policy_document(self, value, path, is_identity_policy, resource_exceptions, start_mark, end_mark):
         """Check policy document"""
-        matches = []
-
-        valid_keys = [
-            'Version',
-            'Id',
-            'Statement',
-        ]
-        valid_versions = ['2012-10-17', '2008-10-17', date(2012, 10, 17), date(2008, 10, 17)]
-
         if isinstance(value, six.string_types):
-            try:
-                value = convert_dict(json.loads(value), start_mark, end_mark)
-            except Exception as ex:  # pylint: disable=W0703,W0612
-                message = 'IAM Policy Documents need to be JSON'
-                matches.append(RuleMatch(path[:], message))
-                return matches
+            cachekey = (value, is_identity_policy, resource_exceptions)
+            if cachekey not in self.string_policies:
+                try:
+                    document = convert_dict(json.loads(value), start_mark, end_mark)
+                except ValueError:
+                    findings = [([], 'IAM Policy Documents need to be JSON')]
+                else:
+                    findings = self._check_policy_document(document, is_identity_policy, resource_exceptions)
+                self.string_policies[cachekey] = findings
+            findings = self.string_policies[cachekey]
+        else:
+            findings = self._check_policy_document(value, is_identity_policy, resource_exceptions)
+        return [RuleMatch(path[:] + finding_path, message) for finding_path, message in findings]
 
+    def _check_policy_document(self, value, is_identity_policy, resource_exceptions):
+        """Check the document in a single pass, returns (path, message) pairs relative to it"""
         if not isinstance(value, dict):
-            message = 'IAM Policy Documents needs to be JSON'
-            matches.append(
-                RuleMatch(path[:], message))
-            return matches
+            return [([], 'IAM Policy Documents needs to be JSON')]
 
-        for p_vs, p_p in value.items_safe(path[:], (dict)):
+        findings = []
+        for p_vs, p_p in value.items_safe([], (dict)):
             for parent_key, parent_value in p_vs.items():
-                if parent_key not in valid_keys:
-                    message = 'IAM Policy key %s doesn\'t exist.' % (parent_key)
-                    matches.append(
-                        RuleMatch(path[:] + p_p + [parent_key], message))
-                if parent_key == 'Version':
-                    if parent_value not in valid_versions:
-                        message = 'IAM Policy Version needs to be one of (%s).' % (
-                            ', '.join(map(str, ['2012-10-17', '2008-10-17'])))
-                        matches.append(
-                            RuleMatch(p_p + [parent_key], message))
-                if parent_key == 'Statement':
+                if parent_key not in POLICY_KEYS:
+                    findings.append((p_p + [parent_key], 'IAM Policy key %s doesn\'t exist.' % (parent_key)))
+                elif parent_key == 'Version':
+                    if parent_value not in POLICY_VERSIONS:
+                        findings.append((p_p + [parent_key], 'IAM Policy Version needs to be one of (%s).' % (
+                            ', '.join(['2012-10-17', '2008-10-17']))))
+                elif parent_key == 'Statement':
                     if isinstance(parent_value, list):
                         for i_s_v, i_s_p in parent_value.items_safe(p_p + ['Statement'], (dict)):
-                            matches.extend(
-                                self._check_policy_statement(
-                                    i_s_p, i_s_v, is_identity_policy, resource_exceptions
-                                )
-                            )
+                            self._check_policy_statement(
+                                findings, i_s_p, i_s_v, is_identity_policy, resource_exceptions)
                     elif isinstance(parent_value, dict):
                         for i_s_v, i_s_p in parent_value.items_safe(p_p + ['Statement']):
-                            matches.extend(
-                                self._check_policy_statement(
-                                    i_s_p, i_s_v, is_identity_policy, resource_exceptions
-                                )
-                            )
+                            self._check_policy_statement(
+                                findings, i_s_p, i_s_v, is_identity_policy, resource_exceptions)
                     else:
-                        message = 'IAM Policy statement should be of list.'
-                        matches.append(
-                            RuleMatch(p_p + [parent_key], message))
-        return matches
+                        findings.append((p_p + [parent_key], 'IAM Policy statement should be of list.'))
+        return findings
 
-    def _check_policy_statement(self, branch, statement, is_identity_policy, resource_exceptions):
-        """Check statements"""
-        matches = []
-        statement_valid_keys = [
-            'Action',
-            'Condition',
-            'Effect',
-            'NotAction',
-            'NotPrincipal',
-            'NotResource',
-            'Principal',
-            'Resource',
-            'Sid',
-        ]
-
-        for key, _ in statement.items():
-            if key not in statement_valid_keys:
-                message = 'IAM Policy statement key %s isn\'t valid' % (key)
-                matches.append(
-                    RuleMatch(branch[:] + [key], message))
-        if 'Effect' not in statement:
-            message = 'IAM Policy statement missing Effect'
-            matches.append(
-                RuleMatch(branch[:], message))
-        else:
-            for effect, effect_path in statement.get_safe('Effect'):
-                if isinstance(effect, six.string_types):
-                    if effect not in ['Allow', 'Deny']:
-                        message = 'IAM Policy Effect should be Allow or Deny'
-                        matches.append(
-                            RuleMatch(branch[:] + effect_path, message))
-        if 'Action' not in statement and 'NotAction' not in statement:
-            message = 'IAM Policy statement missing Action or NotAction'
-            matches.append(
-                RuleMatch(branch[:], message))
+    def _check_policy_statement(self, findings, branch, statement, is_identity_policy, resource_exceptions):
+        """Check statements, adding to the findings"""
+        keys = set()
+        for key, value in statement.items():
+            keys.add(key)
+            if key not in STATEMENT_KEYS:
+                findings.append((branch[:] + [key], 'IAM Policy statement key %s isn\'t valid' % (key)))
+            elif key in ACTION_KEYS:
+                if self.config['actions']:
+                    self._check_actions(findings, branch[:] + [key], value)
+            elif key == 'Effect':
+                if isinstance(value, six.string_types):
+                    if value not in EFFECTS:
+                        findings.append((branch[:] + [key], 'IAM Policy Effect should be Allow or Deny'))
+                else:
+                    for effect, effect_path in statement.get_safe('Effect'):
+                        if isinstance(effect, six.string_types) and effect not in EFFECTS:
+                            findings.append((branch[:] + effect_path, 'IAM Policy Effect should be Allow or Deny'))
+
+        if 'Effect' not in keys:
+            findings.append((branch[:], 'IAM Policy statement missing Effect'))
+        if 'Action' not in keys and 'NotAction' not in keys:
+            findings.append((branch[:], 'IAM Policy statement missing Action or NotAction'))
         if is_identity_policy:
-            if 'Principal' in statement or 'NotPrincipal' in statement:
-                message = 'IAM Resource Policy statement shouldn\'t have Principal or NotPrincipal'
-                matches.append(
-                    RuleMatch(branch[:], message))
+            if 'Principal' in keys or 'NotPrincipal' in keys:
+                findings.append((branch[:], 'IAM Resource Policy statement shouldn\'t have Principal or NotPrincipal'))
         else:
-            if 'Principal' not in statement and 'NotPrincipal' not in statement:
-                message = 'IAM Resource Policy statement should have Principal or NotPrincipal'
-                matches.append(
-                    RuleMatch(branch[:] + ['Principal'], message))
+            if 'Principal' not in keys and 'NotPrincipal' not in keys:
+                findings.append((branch[:] + ['Principal'], 'IAM Resource Policy statement should have Principal or NotPrincipal'))
         if not resource_exceptions:
-            if 'Resource' not in statement and 'NotResource' not in statement:
-                message = 'IAM Policy statement missing Resource or NotResource'
-                matches.append(
-                    RuleMatch(branch[:], message))
+            if 'Resource' not in keys and 'NotResource' not in keys:
+                findings.append((branch[:], 'IAM Policy statement missing Resource or NotResource'))
 
-        return(matches)
+    def _check_actions(self, findings, branch, actions):
+        """Check that the actions exist, adding to the findings"""
+        if isinstance(actions, six.string_types):
+            actions = [(actions, branch)]
+        elif isinstance(actions, list):
+            actions = [(action, branch + [index]) for index, action in enumerate(actions)]
+        else:
+            # Intrinsic functions can't be checked
+            return
+        for action, action_path in actions:
+            if isinstance(action, six.string_types):
+                message = check_action(action)
+                if message is not None:
+                    findings.append((action_path, message))
 
     def match_resource_properties(self, properties, resourcetype, path, cfn):
         """Check CloudFormation Properties"""
         matches = []
 
-        is_identity_policy = True
-        if resourcetype in self.resources_and_keys:
-            is_identity_policy = False
-
-        key = None
-        if resourcetype in self.resources_and_keys:
-            key = self.resources_and_keys.get(resourcetype)
-        else:
-            key = self.idp_and_keys.get(resourcetype)
-
-        if not key:
+        if resourcetype not in self.resource_checks:
             # Key isn't defined return nothing
             return matches
-
-        resource_exceptions = False
-        if key == self.resource_exceptions.get(resourcetype):
-            resource_exceptions = True
-
-        other_keys = []
-        for key, value in self.resources_and_keys.items():
-            if value != 'Policies':
-                other_keys.append(key)
-        for key, value in self.idp_and_keys.items():
-            if value != 'Policies':
-                other_keys.append(key)
+        is_identity_policy, resource_exceptions = self.resource_checks[resourcetype]
 
         for key, value in properties.items():
             if key == 'Policies' and isinstance(value, list):
-                for index, policy in enumerate(properties.get(key, [])):
+                for index, policy in enumerate(value):
                     matches.extend(
                         cfn.check_value(
                             obj=policy, key='PolicyDocument',
@@ -189,7 +267,7 @@ class SSOPolicy(CloudFormationLintRule):
                             resource_exceptions=resource_exceptions,
                             start_mark=key.start_mark, end_mark=key.end_mark,
                         ))
-            elif key in ['KeyPolicy', 'PolicyDocument', 'RepositoryPolicyText', 'AccessPolicies']:
+            elif key in POLICY_PROPERTIES:
                 matches.extend(
                     cfn.check_value(
                         obj=properties, key=key,
@@ -200,4 +278,4 @@ class SSOPolicy(CloudFormationLintRule):
                         start_mark=key.start_mark, end_mark=key.end_mark,
                     ))
 
-        return matches
\ No newline at end of file
+        return matches
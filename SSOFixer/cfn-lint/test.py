@@ -0,0 +1,190 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import cfnlint.core
+import cfnlint.decode
+from cfnlint.rules import RulesCollection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules'))
+import SSOPolicy  # noqa: E402
+
+
+def trie(*actions):
+    # A trie with the given (lower case) actions, like action_catalogue builds
+    root = {}
+    for action in actions:
+        node = root
+        for character in action:
+            node = node.setdefault(character, {})
+        node[''] = True
+    return root
+
+
+class TestActionCatalogue(unittest.TestCase):
+    def setUp(self):
+        SSOPolicy.check_action.cache_clear()
+
+    def testTrieExactMatch(self):
+        actions = trie("getobject", "getobjectacl", "putobject")
+        self.assertTrue(SSOPolicy.trie_matches(actions, "getobject"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "getobjectacl"))
+        self.assertFalse(SSOPolicy.trie_matches(actions, "getobj"))
+        self.assertFalse(SSOPolicy.trie_matches(actions, "deleteobject"))
+
+    def testTrieWildcards(self):
+        actions = trie("getobject", "getobjectacl", "putobject")
+        self.assertTrue(SSOPolicy.trie_matches(actions, "*"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "get*"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "*acl"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "*object*"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "?utobject"))
+        self.assertTrue(SSOPolicy.trie_matches(actions, "g?t*a?l"))
+        self.assertFalse(SSOPolicy.trie_matches(actions, "delete*"))
+        self.assertFalse(SSOPolicy.trie_matches(actions, "*policy"))
+        self.assertFalse(SSOPolicy.trie_matches(actions, "?etobjec"))
+
+    def testExistingActions(self):
+        self.assertIsNone(SSOPolicy.check_action("s3:GetObject"))
+        self.assertIsNone(SSOPolicy.check_action("*"))
+
+    def testActionsAreCaseInsensitive(self):
+        self.assertIsNone(SSOPolicy.check_action("S3:getobject"))
+        self.assertIsNone(SSOPolicy.check_action("s3:GETOBJECT"))
+
+    def testActionWildcards(self):
+        self.assertIsNone(SSOPolicy.check_action("s3:*"))
+        self.assertIsNone(SSOPolicy.check_action("s3:Get*"))
+        self.assertIsNone(SSOPolicy.check_action("s3:G?tObject"))
+        self.assertEqual(SSOPolicy.check_action("s3:Nope*"), "IAM Policy action s3:Nope* doesn't match any actions")
+
+    def testServiceWildcards(self):
+        self.assertIsNone(SSOPolicy.check_action("*:GetObject"))
+        self.assertIsNone(SSOPolicy.check_action("a*:*"))
+        self.assertIsNone(SSOPolicy.check_action("s?:GetObject"))
+        self.assertEqual(SSOPolicy.check_action("*:NoSuchActionAnywhere"),
+                         "IAM Policy action *:NoSuchActionAnywhere doesn't match any actions")
+
+    def testActionThatDoesntExist(self):
+        self.assertEqual(SSOPolicy.check_action("s3:Nope"), "IAM Policy action s3:Nope doesn't exist")
+
+    def testUnknownService(self):
+        self.assertEqual(SSOPolicy.check_action("nope:GetObject"), "IAM Policy action nope:GetObject has an unknown service nope")
+
+    def testMalformedActions(self):
+        for action in ["GetObject", "s3:", ":GetObject"]:
+            self.assertEqual(SSOPolicy.check_action(action),
+                             "IAM Policy action %s should be in the format service:action" % action)
+
+
+TEMPLATE = """
+Parameters:
+  Policy:
+    Type: String
+Conditions:
+  IsProduction: !Equals [!Ref AWS::Region, us-east-1]
+Resources:
+  BadActions:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: BadActions
+      PolicyDocument:
+        Version: 2012-10-17
+        Statement:
+          - Effect: Allow
+            Action: [s3:GetObject, s3:Nope, nope:GetObject]
+            Resource: "*"
+  FromParameter:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: FromParameter
+      PolicyDocument: !Ref Policy
+  Conditional:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: Conditional
+      PolicyDocument: !If
+        - IsProduction
+        - Version: 2012-10-17
+          Statement:
+            - Effect: Allow
+              Action: s3:Nope
+              Resource: "*"
+        - !Ref AWS::NoValue
+  FromString:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: FromString
+      PolicyDocument: '%(policy)s'
+  SameString:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: SameString
+      PolicyDocument: '%(policy)s'
+  NotJson:
+    Type: AWS::SSO::PermissionSet
+    Properties:
+      InstanceArn: arn:aws:sso:::instance/ssoins-1234567890abcdef
+      Name: NotJson
+      PolicyDocument: 'Allow everything'
+""" % {"policy": json.dumps({
+    "Version": "2012-10-17",
+    "Statement": [{"Effect": "Maybe", "Action": "s3:Nope", "Resource": "*"}]})}
+
+
+class TestRule(unittest.TestCase):
+    def setUp(self):
+        SSOPolicy.check_action.cache_clear()
+
+    def lint(self, configure_rules=None):
+        # The (path, message) of every finding of the rule in TEMPLATE
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as templatefile:
+            templatefile.write(TEMPLATE)
+        self.addCleanup(os.remove, templatefile.name)
+        template, errors = cfnlint.decode.decode(templatefile.name)
+        self.assertEqual(errors, [])
+        rules = RulesCollection(configure_rules=configure_rules)
+        rules.register(SSOPolicy.SSOPolicy())
+        matches = cfnlint.core.run_checks(templatefile.name, template, rules, ['us-east-1'])
+        return [(match.path, match.message) for match in matches]
+
+    def testFindings(self):
+        self.assertEqual(self.lint(), [
+            (['Resources', 'BadActions', 'Properties', 'PolicyDocument', 'Statement', 0, 'Action', 1],
+             "IAM Policy action s3:Nope doesn't exist"),
+            (['Resources', 'BadActions', 'Properties', 'PolicyDocument', 'Statement', 0, 'Action', 2],
+             "IAM Policy action nope:GetObject has an unknown service nope"),
+            (['Resources', 'Conditional', 'Properties', 'PolicyDocument', 'Fn::If', 1, 'Statement', 0, 'Action'],
+             "IAM Policy action s3:Nope doesn't exist"),
+            (['Resources', 'FromString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Effect'],
+             "IAM Policy Effect should be Allow or Deny"),
+            (['Resources', 'FromString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Action'],
+             "IAM Policy action s3:Nope doesn't exist"),
+            # A string policy is only checked once, its findings are reported
+            # for every permission set that uses it
+            (['Resources', 'SameString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Effect'],
+             "IAM Policy Effect should be Allow or Deny"),
+            (['Resources', 'SameString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Action'],
+             "IAM Policy action s3:Nope doesn't exist"),
+            (['Resources', 'NotJson', 'Properties', 'PolicyDocument'],
+             "IAM Policy Documents need to be JSON")])
+
+    def testActionsCanBeTurnedOff(self):
+        self.assertEqual(self.lint({'E9001': {'actions': 'false'}}), [
+            (['Resources', 'FromString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Effect'],
+             "IAM Policy Effect should be Allow or Deny"),
+            (['Resources', 'SameString', 'Properties', 'PolicyDocument', 'Statement', 0, 'Effect'],
+             "IAM Policy Effect should be Allow or Deny"),
+            (['Resources', 'NotJson', 'Properties', 'PolicyDocument'],
+             "IAM Policy Documents need to be JSON")])
+
+
+if __name__ == '__main__':
+    unittest.main()
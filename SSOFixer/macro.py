@@ -1,39 +1,593 @@
+import hashlib
 import json
-import boto3
+import mmap
 import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-def handler(event, context):
+from macrokit import Metrics, instrumented, transform_resources
+
+# orjson is used for serialising policies when it's included in the package.
+# Like boto3 it's only imported once it's needed; False means it isn't available.
+ORJSON = None
+
+# boto3 is only imported, and the client only created, once a lookup table is
+# configured. The client is then reused for as long as the container is warm.
+S3_CLIENT = None
+
+# Like the S3 client, the Identity Store client is only created once an
+# Identity Store is configured.
+IDENTITYSTORE_CLIENT = None
+
+# PrincipalIds found in the Identity Store, keyed on (PrincipalType, name) and
+# kept for as long as the Lambda container stays warm.
+PRINCIPAL_CACHE = {}
+
+# The attribute that holds the name of each PrincipalType in the Identity Store
+PRINCIPAL_NAME_ATTRIBUTES = {
+    'USER': 'userName',
+    'GROUP': 'displayName'
+}
+
+# The maximum size of an inline policy in a permission set, in bytes
+INLINE_POLICY_LIMIT = 32768
+
+# Inline policies larger than this are logged, as they're close to the limit
+INLINE_POLICY_WARNING = INLINE_POLICY_LIMIT * 9 // 10
+
+# Statements with only these keys can be merged with each other
+MERGEABLE_STATEMENT_KEYS = frozenset(['Sid', 'Effect', 'Action', 'Resource', 'NotResource', 'Condition'])
+
+# Lookup tables with a key ending in this suffix are in the sorted index format
+LOOKUP_INDEX_SUFFIX = '.tsv'
+
+# Lookup tables are also stored in /tmp, so a new execution environment that
+# gets the same storage doesn't have to download them again. Entries written
+# with a different version are ignored.
+DISK_CACHE_VERSION = 1
+
+# Temporary files older than this (the longest a Lambda invocation can run, in
+# seconds) are left over from a write that failed, and are removed
+DISK_CACHE_TEMPORARY_MAX_AGE = 900
+
+# Hits and misses of the disk cache in this execution environment
+DISK_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# Parsed lookup tables, kept for as long as the Lambda container stays warm.
+# Keyed on (bucket, key) with the ETag and the time it was last validated.
+LOOKUP_CACHE = {}
+
+
+def get_s3_client():
+    global S3_CLIENT
+    if S3_CLIENT is None:
+        import boto3
+        from botocore.config import Config
+        config = Config(max_pool_connections=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '10')))
+        S3_CLIENT = boto3.client('s3', config=config)
+    return S3_CLIENT
+
+
+def identitystore_max_workers():
+    return int(os.environ.get('IDENTITYSTORE_MAX_WORKERS', '10'))
+
+
+def get_identitystore_client():
+    global IDENTITYSTORE_CLIENT
+    if IDENTITYSTORE_CLIENT is None:
+        import boto3
+        from botocore.config import Config
+        # Enough connections for every lookup thread
+        config = Config(max_pool_connections=identitystore_max_workers())
+        IDENTITYSTORE_CLIENT = boto3.client('identitystore', config=config)
+    return IDENTITYSTORE_CLIENT
+
+
+def lookup_cache_ttl():
+    return int(os.environ.get('LOOKUPTABLE_CACHE_TTL', '300'))
+
+
+def lookup_cache_dir():
+    return os.environ.get('LOOKUPTABLE_CACHE_DIR', tempfile.gettempdir())
+
+
+class LookupIndex:
+    # A lookup table in the sorted index format: one "name<TAB>id" line per
+    # principal, sorted by name (as UTF-8 bytes). The file is memory-mapped and
+    # binary searched, so only the lines on the way to a name are read.
+    def __init__(self, path):
+        with open(path, 'rb') as indexfile:
+            size = os.fstat(indexfile.fileno()).st_size
+            self.map = mmap.mmap(indexfile.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    @classmethod
+    def from_bytes(cls, data):
+        # An index that's kept in memory, when it can't be stored in /tmp
+        index = cls.__new__(cls)
+        index.map = data
+        return index
+
+    def find(self, name):
+        target = name.encode('utf-8')
+        low, high = 0, len(self.map)
+        # low and high are always at the start of a line
+        while low < high:
+            middle = (low + high) // 2
+            start = self.map.rfind(b'\n', low, middle) + 1 or low
+            end = self.map.find(b'\n', start, high)
+            if end == -1:
+                end = high
+            key, _, value = self.map[start:end].partition(b'\t')
+            if key == target:
+                return value.rstrip(b'\r').decode('utf-8')
+            if key < target:
+                low = end + 1
+            else:
+                high = start
+        return None
+
+    def __contains__(self, name):
+        return self.find(name) is not None
+
+    def __getitem__(self, name):
+        value = self.find(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+
+def build_lookup_index(lookupdict):
+    # The sorted index format for a lookup table, as bytes
+    lines = []
+    for name, principal_id in lookupdict.items():
+        if any(character in str(value) for value in [name, principal_id] for character in '\t\r\n'):
+            raise ValueError("%s: names and ids in the lookup table can't contain tabs or newlines" % name)
+        lines.append(("%s\t%s\n" % (name, principal_id)).encode('utf-8'))
+    return b''.join(sorted(lines, key=lambda line: line.split(b'\t', 1)[0]))
+
+
+def disk_cache_max_age():
+    return int(os.environ.get('LOOKUPTABLE_DISK_CACHE_MAX_AGE', '86400'))
+
+
+def disk_cache_max_bytes():
+    return int(os.environ.get('LOOKUPTABLE_DISK_CACHE_MAX_BYTES', str(128 * 1024 * 1024)))
+
+
+def disk_cache_paths(bucketname, key):
+    # The data and metadata files of a lookup table in the disk cache
+    name = hashlib.sha256(("%s/%s" % (bucketname, key)).encode('utf-8')).hexdigest()[:16]
+    base = os.path.join(lookup_cache_dir(), "ssofixer-%s" % name)
+    suffix = LOOKUP_INDEX_SUFFIX if key.endswith(LOOKUP_INDEX_SUFFIX) else '.json'
+    return base + suffix, base + '.meta'
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def replace_file(path, write):
+    # Files are written next to the old version and then moved over it, so an
+    # index that's still mapped keeps its own copy and no one reads half a file
+    newfile = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='ssofixer-', suffix='.tmp', delete=False)
+    try:
+        with newfile:
+            write(newfile)
+        os.replace(newfile.name, path)
+    except Exception:
+        remove_file(newfile.name)
+        raise
+
+
+def parse_lookup_table(key, path):
+    if key.endswith(LOOKUP_INDEX_SUFFIX):
+        return LookupIndex(path)
+    with open(path, 'rb') as tablefile:
+        return json.loads(tablefile.read().decode('utf-8'))
+
+
+def parse_lookup_data(key, data):
+    # Like parse_lookup_table, for a table that's only kept in memory
+    if key.endswith(LOOKUP_INDEX_SUFFIX):
+        return LookupIndex.from_bytes(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def disk_cache_failed(bucketname, key, error):
+    # A full or read-only /tmp only means the table isn't shared with later
+    # execution environments, the invocation itself carries on
+    print("WARNING: s3://%s/%s: can't store the lookup table in %s: %s" % (
+        bucketname, key, lookup_cache_dir(), error))
+
+
+def write_disk_cache_metadata(bucketname, key, cached):
+    datapath, metapath = disk_cache_paths(bucketname, key)
+    metadata = {
+        "version": DISK_CACHE_VERSION,
+        "bucket": bucketname,
+        "key": key,
+        "etag": cached['etag'],
+        "size": os.path.getsize(datapath),
+        "validated": cached['validated']
+    }
+    replace_file(metapath, lambda metafile: metafile.write(json.dumps(metadata).encode('utf-8')))
+
+
+def read_disk_cache(bucketname, key):
+    # The cache entry for a lookup table stored in /tmp by this or an earlier
+    # execution environment, or None if there isn't a usable one
+    datapath, metapath = disk_cache_paths(bucketname, key)
+    try:
+        with open(metapath, 'rb') as metafile:
+            metadata = json.loads(metafile.read().decode('utf-8'))
+        if metadata.get('version') != DISK_CACHE_VERSION or metadata.get('bucket') != bucketname or metadata.get('key') != key:
+            return None
+        if time.time() - metadata['validated'] > disk_cache_max_age() or os.path.getsize(datapath) != metadata['size']:
+            return None
+        table = parse_lookup_table(key, datapath)
+    except (OSError, ValueError, KeyError):
+        return None
+    return {"etag": metadata['etag'], "table": table, "validated": metadata['validated']}
+
+
+def write_disk_cache(bucketname, key, body, etag, validated, metrics):
+    # Streams a downloaded lookup table into the disk cache and returns its entry
+    datapath, _ = disk_cache_paths(bucketname, key)
+    with metrics.phase("LookupFetch"):
+        replace_file(datapath, lambda datafile: shutil.copyfileobj(body, datafile, 1024 * 1024))
+    with metrics.phase("LookupParse"):
+        table = parse_lookup_table(key, datapath)
+    cached = {"etag": etag, "table": table, "validated": validated}
+    try:
+        write_disk_cache_metadata(bucketname, key, cached)
+    except OSError as error:
+        # Without its metadata the table is never used or evicted. An index
+        # stays readable, as its mapping keeps the removed file.
+        disk_cache_failed(bucketname, key, error)
+        remove_file(datapath)
+    evict_disk_cache(datapath)
+    return cached
+
+
+def evict_disk_cache(keep):
+    # Removes tables that are too old, and then the least recently validated
+    # ones until the cache fits in its maximum size
+    cachedir = lookup_cache_dir()
+    entries = []
+    now = time.time()
+    for name in os.listdir(cachedir):
+        if name.startswith('ssofixer-') and name.endswith('.tmp'):
+            path = os.path.join(cachedir, name)
+            try:
+                if now - os.path.getmtime(path) > DISK_CACHE_TEMPORARY_MAX_AGE:
+                    os.remove(path)
+            except OSError:
+                pass
+            continue
+        if not (name.startswith('ssofixer-') and name.endswith('.meta')):
+            continue
+        metapath = os.path.join(cachedir, name)
+        try:
+            with open(metapath, 'rb') as metafile:
+                metadata = json.loads(metafile.read().decode('utf-8'))
+            datapath = disk_cache_paths(metadata['bucket'], metadata['key'])[0]
+            entries.append((metadata['validated'], datapath, metapath, metadata['size']))
+        except (OSError, ValueError, KeyError):
+            continue
+    entries.sort()
+    size = sum(entry[3] for entry in entries)
+    for validated, datapath, metapath, entrysize in entries:
+        if datapath == keep or (now - validated <= disk_cache_max_age() and size <= disk_cache_max_bytes()):
+            continue
+        remove_file(metapath)
+        remove_file(datapath)
+        size -= entrysize
+
+
+def count_disk_cache(hit, bucketname, key, metrics):
+    DISK_CACHE_STATS['hits' if hit else 'misses'] += 1
+    metrics.add("DiskCacheHits" if hit else "DiskCacheMisses", 1)
+    print("s3://%s/%s: lookup table disk cache %s (%d hits, %d misses)" % (
+        bucketname, key, "hit" if hit else "miss", DISK_CACHE_STATS['hits'], DISK_CACHE_STATS['misses']))
+
+
+def is_not_modified(error):
+    response = error.response
+    if response.get('Error', {}).get('Code') in ['304', 'NotModified']:
+        return True
+    return response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 304
+
+
+def get_lookup_table(s3client, bucketname, key, metrics=None):
+    # The table counts as a cache hit when it doesn't have to be downloaded
+    from botocore.exceptions import ClientError
+    if metrics is None:
+        metrics = Metrics("SSOFixer")
+    cachekey = (bucketname, key)
+    cached = LOOKUP_CACHE.get(cachekey)
+    # Whether the disk cache had the table, None if it wasn't needed
+    ondisk = None
+    if cached is None:
+        with metrics.phase("LookupParse"):
+            cached = read_disk_cache(bucketname, key)
+        ondisk = cached is not None
+        if ondisk:
+            LOOKUP_CACHE[cachekey] = cached
+    now = time.time()
+    if cached is not None and now - cached['validated'] < lookup_cache_ttl():
+        if ondisk:
+            count_disk_cache(True, bucketname, key, metrics)
+        metrics.add("LookupCacheHits", 1)
+        return cached['table']
+
+    request = {"Bucket": bucketname, "Key": key}
+    if cached is not None:
+        request['IfNoneMatch'] = cached['etag']
+    try:
+        with metrics.phase("LookupFetch"):
+            obj = s3client.get_object(**request)
+    except ClientError as error:
+        if cached is None or not is_not_modified(error):
+            raise
+        cached['validated'] = now
+        try:
+            write_disk_cache_metadata(bucketname, key, cached)
+        except OSError as error:
+            disk_cache_failed(bucketname, key, error)
+        if ondisk:
+            count_disk_cache(True, bucketname, key, metrics)
+        metrics.add("LookupCacheHits", 1)
+        return cached['table']
+
+    if ondisk is not None:
+        count_disk_cache(False, bucketname, key, metrics)
+    metrics.add("LookupCacheMisses", 1)
+    try:
+        cached = write_disk_cache(bucketname, key, obj['Body'], obj.get('ETag'), now, metrics)
+    except OSError as error:
+        # Part of the body may already be written, so the table is downloaded
+        # again and kept in memory only
+        disk_cache_failed(bucketname, key, error)
+        with metrics.phase("LookupFetch"):
+            obj = s3client.get_object(Bucket=bucketname, Key=key)
+            data = obj['Body'].read()
+        with metrics.phase("LookupParse"):
+            table = parse_lookup_data(key, data)
+        cached = {"etag": obj.get('ETag'), "table": table, "validated": now}
+    LOOKUP_CACHE[cachekey] = cached
+    return cached['table']
+
+
+def lookup_principal(client, identitystoreid, principal_type, name):
+    # Returns the PrincipalId from the Identity Store, or None if there isn't one
+    from botocore.exceptions import ClientError
+    if principal_type not in PRINCIPAL_NAME_ATTRIBUTES:
+        return None
+    identifier = {
+        "UniqueAttribute": {
+            "AttributePath": PRINCIPAL_NAME_ATTRIBUTES[principal_type],
+            "AttributeValue": name
+        }
+    }
+    try:
+        if principal_type == 'USER':
+            return client.get_user_id(IdentityStoreId=identitystoreid, AlternateIdentifier=identifier)['UserId']
+        return client.get_group_id(IdentityStoreId=identitystoreid, AlternateIdentifier=identifier)['GroupId']
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') == 'ResourceNotFoundException':
+            return None
+        raise
+
+
+def principal_key(properties):
+    # The (PrincipalType, PrincipalName) of an assignment, or None if either
+    # is an intrinsic function, which only CloudFormation can resolve
+    key = (properties.get('PrincipalType'), properties['PrincipalName'])
+    if not isinstance(key[1], str) or not isinstance(key[0], (str, type(None))):
+        return None
+    return key
+
+
+def principal_names(fragment):
+    # All distinct (PrincipalType, PrincipalName) pairs in the fragment
+    names = set()
+    for definition in fragment['Resources'].values():
+        if definition.get('Type') == 'AWS::SSO::Assignment':
+            properties = definition.get('Properties', {})
+            if "PrincipalName" in properties:
+                key = principal_key(properties)
+                if key is not None:
+                    names.add(key)
+    return names
+
+
+def resolve_principals(names, client, identitystoreid, load_lookup_table, metrics):
+    # Looks up all names in the Identity Store at once, using a thread per
+    # lookup up to the configured maximum. Names that aren't found there are
+    # looked up in the lookup table, which is only loaded if it's needed.
+    if client is not None:
+        missing = [key for key in names if key not in PRINCIPAL_CACHE]
+        metrics.add("PrincipalCacheHits", len(names) - len(missing))
+        metrics.add("PrincipalCacheMisses", len(missing))
+        if missing:
+            with ThreadPoolExecutor(max_workers=min(identitystore_max_workers(), len(missing))) as executor:
+                principal_ids = executor.map(
+                    lambda key: lookup_principal(client, identitystoreid, key[0], key[1]), missing)
+                for key, principal_id in zip(missing, principal_ids):
+                    if principal_id is not None:
+                        PRINCIPAL_CACHE[key] = principal_id
+    principals = {}
+    lookupdict = None
+    for key in names:
+        if client is not None and key in PRINCIPAL_CACHE:
+            principals[key] = PRINCIPAL_CACHE[key]
+            continue
+        if lookupdict is None:
+            lookupdict = load_lookup_table() or {}
+        if key[1] in lookupdict:
+            principals[key] = lookupdict[key[1]]
+    return principals
+
+
+def get_orjson():
+    global ORJSON
+    if ORJSON is None:
+        try:
+            import orjson
+            ORJSON = orjson
+        except ImportError:
+            ORJSON = False
+    return ORJSON
+
+
+def dumps_policy(document):
+    # Compact and with sorted keys, so the same document always results in the
+    # same InlinePolicy regardless of which serialiser is used
+    orjson = get_orjson()
+    if orjson:
+        return orjson.dumps(document, option=orjson.OPT_SORT_KEYS).decode('utf-8')
+    return json.dumps(document, separators=(',', ':'), sort_keys=True, ensure_ascii=False)
+
+
+def unique_actions(actions):
+    # Actions are case insensitive, the first spelling of each is kept
+    seen = set()
+    result = []
+    for action in actions:
+        key = action.lower() if isinstance(action, str) else dumps_policy(action)
+        if key not in seen:
+            seen.add(key)
+            result.append(action)
+    return result
+
+
+def compact_policy(document):
+    # Merges statements that only differ in their Action (and Sid, of which the
+    # first one is kept) and removes duplicate actions. Returns a new document,
+    # the original isn't changed.
+    statements = document.get('Statement')
+    if isinstance(statements, dict):
+        statements = [statements]
+    if not isinstance(statements, list):
+        return document
+    compacted = []
+    groups = {}
+    for statement in statements:
+        if not isinstance(statement, dict) or "Action" not in statement or not MERGEABLE_STATEMENT_KEYS.issuperset(statement):
+            compacted.append(statement)
+            continue
+        key = dumps_policy(dict((k, v) for k, v in statement.items() if k not in ['Sid', 'Action']))
+        actions = statement['Action'] if isinstance(statement['Action'], list) else [statement['Action']]
+        if key in groups:
+            groups[key]['Action'] = groups[key]['Action'] + actions
+        else:
+            groups[key] = dict(statement)
+            groups[key]['Action'] = actions
+            compacted.append(groups[key])
+    for statement in groups.values():
+        statement['Action'] = unique_actions(statement['Action'])
+        if len(statement['Action']) == 1:
+            statement['Action'] = statement['Action'][0]
+    result = dict(document)
+    result['Statement'] = compacted
+    return result
+
+
+def updated_resource(definition):
+    # A copy of the resource and its properties to change, sharing all other
+    # values with the original definition
+    updated = dict(definition)
+    updated['Properties'] = dict(definition['Properties'])
+    return updated
+
+
+def fix_permission_set(resource, definition, principals):
+    # Turn Permission Set PolicyDocument into InlinePolicy
+    if "PolicyDocument" not in definition['Properties']:
+        yield "Resources", resource, definition
+        return
+    updated = updated_resource(definition)
+    properties = updated['Properties']
+    policy = dumps_policy(compact_policy(properties.pop('PolicyDocument')))
+    size = len(policy.encode('utf-8'))
+    if size > INLINE_POLICY_LIMIT:
+        raise ValueError("%s: InlinePolicy is %d bytes, more than the limit of %d" % (
+            resource, size, INLINE_POLICY_LIMIT))
+    if size > INLINE_POLICY_WARNING:
+        print("WARNING: %s: InlinePolicy is %d bytes, close to the limit of %d" % (
+            resource, size, INLINE_POLICY_LIMIT))
+    properties['InlinePolicy'] = policy
+    yield "Resources", resource, updated
+
+
+def fix_assignment(resource, definition, principals):
+    if principals is None or "PrincipalName" not in definition['Properties']:
+        yield "Resources", resource, definition
+        return
+    updated = updated_resource(definition)
+    properties = updated['Properties']
+    key = principal_key(properties)
+    if key is None:
+        raise ValueError("%s: PrincipalName can only be looked up when it and PrincipalType are strings" % resource)
+    if key not in principals:
+        raise ValueError("%s: PrincipalName %s can't be found" % (resource, key[1]))
+    properties['PrincipalId'] = principals[key]
+    properties.pop('PrincipalName')
+    yield "Resources", resource, updated
+
+
+# Handlers per resource Type for macrokit.transform_resources. Each receives
+# the logical ID, the resource definition, and the PrincipalIds by
+# (PrincipalType, name) (None if neither an Identity Store nor a lookup table
+# is configured).
+RESOURCE_HANDLERS = {
+    'AWS::SSO::PermissionSet': fix_permission_set,
+    'AWS::SSO::Assignment': fix_assignment
+}
+
+
+@instrumented("SSOFixer")
+def handler(event, context, metrics):
     macro_response = {
         "requestId": event["requestId"],
         "status": "success"
     }
     # Globals
     fragment = event['fragment']
-    result = fragment
 
     lookups = False
+    load_lookup_table = lambda: None
     if 'BUCKET_NAME' in os.environ and 'LOOKUPTABLE_PREFIX' in os.environ:
         bucketname = os.environ['BUCKET_NAME']
         lookuptableprefix = os.environ['LOOKUPTABLE_PREFIX']
         if bucketname != "" and lookuptableprefix != "":
-            s3 = boto3.resource('s3')
-            key = "lookuptable.json"
-            obj = s3.Object(bucketname, lookuptableprefix)
-            lookupstring = obj.get()['Body'].read().decode('utf-8')
-            lookupdict = json.loads(lookupstring)
+            load_lookup_table = lambda: get_lookup_table(get_s3_client(), bucketname, lookuptableprefix, metrics)
             lookups = True
+    identitystoreid = os.environ.get('IDENTITYSTORE_ID', "")
+    if identitystoreid != "":
+        lookups = True
+
+    principals = None
+    if lookups:
+        names = principal_names(fragment)
+        identitystore = None
+        if identitystoreid != "" and names:
+            identitystore = get_identitystore_client()
+        with metrics.phase("Lookup"):
+            principals = resolve_principals(names, identitystore, identitystoreid, load_lookup_table, metrics)
 
-    for resource in list(fragment["Resources"].keys()):
-        # Turn Permission Set PolicyDocument into InlinePolicy
-        if fragment['Resources'][resource]['Type'] == 'AWS::SSO::PermissionSet':
-            if "PolicyDocument" in list(fragment['Resources'][resource]["Properties"]):
-                policy = json.dumps(fragment['Resources'][resource]['Properties']['PolicyDocument'])
-                result['Resources'][resource]['Properties']['InlinePolicy'] = policy
-                result['Resources'][resource]['Properties'].pop('PolicyDocument')
-        if fragment['Resources'][resource]['Type'] == 'AWS::SSO::Assignment':
-            if lookups == True and "PrincipalName" in list(fragment['Resources'][resource]["Properties"]):
-                result['Resources'][resource]['Properties']['PrincipalId'] = lookupdict[fragment['Resources'][resource]["Properties"]["PrincipalName"]]
-                result['Resources'][resource]['Properties'].pop('PrincipalName')
+    try:
+        with metrics.phase("Expand"):
+            result = transform_resources(fragment, RESOURCE_HANDLERS, principals)
+    except ValueError as error:
+        macro_response['status'] = "failure"
+        macro_response['errorMessage'] = str(error)
+        return macro_response
 
     macro_response['fragment'] = result
     return macro_response
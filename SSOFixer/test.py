@@ -1,13 +1,81 @@
 import boto3
+from botocore.exceptions import ClientError
 from moto import mock_s3
 import mock
+import contextlib
+import errno
+import io
 import os
 import macro
 import json
+import tempfile
+import time
 import unittest
 
 
+class StubBody(io.BytesIO):
+    def __init__(self, content):
+        super().__init__(content.encode('utf-8'))
+
+
+class StubS3Client:
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+        self.calls = []
+
+    def get_object(self, **kwargs):
+        self.calls.append(kwargs)
+        if kwargs.get('IfNoneMatch') == self.etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+        return {"Body": StubBody(self.content), "ETag": self.etag}
+
+
+class StubIdentityStoreClient:
+    def __init__(self, users, groups):
+        self.users = users
+        self.groups = groups
+        self.calls = []
+
+    def lookup(self, principals, IdentityStoreId, AlternateIdentifier):
+        name = AlternateIdentifier["UniqueAttribute"]["AttributeValue"]
+        self.calls.append((IdentityStoreId, AlternateIdentifier["UniqueAttribute"]["AttributePath"], name))
+        if name not in principals:
+            raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "Not found"}}, "GetId")
+        return principals[name]
+
+    def get_user_id(self, **kwargs):
+        return {"UserId": self.lookup(self.users, **kwargs)}
+
+    def get_group_id(self, **kwargs):
+        return {"GroupId": self.lookup(self.groups, **kwargs)}
+
+
+def assignment(principal_type, principal_name):
+    return {"Type": "AWS::SSO::Assignment", "Properties": {
+        "PrincipalType": principal_type, "PrincipalName": principal_name}}
+
+
+def emitted_metrics(output):
+    # The Embedded Metric Format records among the lines that were printed
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{"_aws"')]
+
+
 class TestStringMethods(unittest.TestCase):
+    def setUp(self):
+        macro.LOOKUP_CACHE.clear()
+        macro.PRINCIPAL_CACHE.clear()
+        macro.S3_CLIENT = None
+        macro.IDENTITYSTORE_CLIENT = None
+        macro.DISK_CACHE_STATS.update(hits=0, misses=0)
+        # Every test gets its own, empty, disk cache
+        cachedir = tempfile.TemporaryDirectory()
+        self.addCleanup(cachedir.cleanup)
+        environment = mock.patch.dict(os.environ, {"LOOKUPTABLE_CACHE_DIR": cachedir.name})
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.cachedir = cachedir.name
+
     def testNonSSOPassedThrough(self):
         event = {}
         event["region"] = "ap-southeast-2"
@@ -37,7 +105,7 @@ class TestStringMethods(unittest.TestCase):
                     "Resource": "*"
                 }
             ]}}}}}
-        expected_policy = "{\"Version\": \"2012-10-17\", \"Statement\": [{\"Effect\": \"Allow\", \"Action\": \"*\", \"Resource\": \"*\"}]}"
+        expected_policy = "{\"Statement\":[{\"Action\":\"*\",\"Effect\":\"Allow\",\"Resource\":\"*\"}],\"Version\":\"2012-10-17\"}"
         result = macro.handler(event, None)
         fragment = result["fragment"]
         expected_resources = ["PermSet"]
@@ -123,5 +191,377 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(properties_totest["PrincipalName"], "My Name")
         self.assertRaises(KeyError, lambda: properties_totest["PrincipalId"])
 
+    @mock.patch.dict(os.environ, {"LOOKUPTABLE_CACHE_TTL": "300"})
+    def testLookupTableCachedWithinTTL(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        first = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        second = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(first, {"My Name": "abcdef-123456"})
+        self.assertIs(first, second)
+        self.assertEqual(len(s3.calls), 1)
+
+    @mock.patch.dict(os.environ, {"LOOKUPTABLE_CACHE_TTL": "0"})
+    def testLookupTableRevalidatedWithETag(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        first = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        second = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertIs(first, second)
+        self.assertEqual(len(s3.calls), 2)
+        self.assertEqual(s3.calls[1]["IfNoneMatch"], "\"etag1\"")
+
+    @mock.patch.dict(os.environ, {"LOOKUPTABLE_CACHE_TTL": "0"})
+    def testLookupTableReloadedWhenChanged(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        s3.content = "{\"My Name\":\"ghijkl-789012\"}"
+        s3.etag = "\"etag2\""
+        result = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(result, {"My Name": "ghijkl-789012"})
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "", "LOOKUPTABLE_PREFIX": ""})
+    def testS3ClientNotCreatedWithoutLookuptable(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Assmnt": {
+            "Type": "AWS::SSO::Assignment", "Properties": { "PrincipalName": "My Name" }}}}
+        macro.handler(event, None)
+        self.assertIsNone(macro.S3_CLIENT)
+
+    @mock_s3
+    def testS3ClientReused(self):
+        first = macro.get_s3_client()
+        second = macro.get_s3_client()
+        self.assertIs(first, second)
+
+    def testFragmentIsNotChanged(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"PermSet": {
+            "Type": "AWS::SSO::PermissionSet", "Properties": { "Name": "Test", "PolicyDocument": { "Version": "2012-10-17",
+            "Statement": [{"Effect": "Allow", "Action": "*", "Resource": "*"}]}}}}}
+        original = json.dumps(event["fragment"])
+        result = macro.handler(event, None)
+        fragment = result["fragment"]
+        self.assertEqual(json.dumps(event["fragment"]), original)
+        self.assertEqual(fragment["Resources"]["PermSet"]["Properties"]["Name"], "Test")
+        self.assertRaises(KeyError, lambda: fragment["Resources"]["PermSet"]["Properties"]["PolicyDocument"])
+
+    def testDumpsPolicyWithoutOrjson(self):
+        document = {"Version": "2012-10-17", "Statement": [
+            {"Effect": "Allow", "Action": ["s3:GetObject"], "Resource": "arn:aws:s3:::bucket/é"}]}
+        expected_policy = macro.dumps_policy(document)
+        with mock.patch.object(macro, "ORJSON", False):
+            self.assertEqual(macro.dumps_policy(document), expected_policy)
+        self.assertEqual(json.loads(expected_policy), document)
+
+    def testSSOPolicyDocumentCompacted(self):
+        document = {"Version": "2012-10-17", "Statement": [
+            {"Sid": "Read", "Effect": "Allow", "Action": ["s3:GetObject", "S3:getobject"], "Resource": "*"},
+            {"Effect": "Deny", "Action": "iam:*", "Resource": "*"},
+            {"Sid": "Write", "Effect": "Allow", "Action": "s3:PutObject", "Resource": "*"},
+            {"Effect": "Allow", "NotAction": "s3:*", "Resource": "*"},
+            {"Effect": "Deny", "Action": "iam:*", "Resource": "*"}]}
+        expected_document = {"Version": "2012-10-17", "Statement": [
+            {"Sid": "Read", "Effect": "Allow", "Action": ["s3:GetObject", "s3:PutObject"], "Resource": "*"},
+            {"Effect": "Deny", "Action": "iam:*", "Resource": "*"},
+            {"Effect": "Allow", "NotAction": "s3:*", "Resource": "*"}]}
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"PermSet": {
+            "Type": "AWS::SSO::PermissionSet", "Properties": {"PolicyDocument": document}}}}
+        result = macro.handler(event, None)
+        properties_totest = result["fragment"]["Resources"]["PermSet"]["Properties"]
+        self.assertEqual(json.loads(properties_totest["InlinePolicy"]), expected_document)
+        self.assertEqual(len(document["Statement"]), 5)
+
+    def testOnlyLargeInlinePoliciesLogged(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "Small": {"Type": "AWS::SSO::PermissionSet", "Properties": {"PolicyDocument": {
+                "Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}]}}},
+            "Large": {"Type": "AWS::SSO::PermissionSet", "Properties": {"PolicyDocument": {
+                "Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "x" * 31000}]}}}}}
+        output = io.StringIO()
+        with mock.patch.dict(os.environ, {"METRICS_NAMESPACE": ""}), contextlib.redirect_stdout(output):
+            result = macro.handler(event, None)
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(output.getvalue().splitlines(), [
+            "WARNING: Large: InlinePolicy is 31072 bytes, close to the limit of 32768"])
+
+    def testSSOPolicyTooLargeFails(self):
+        statements = [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "arn:aws:s3:::bucket-%d/*" % i} for i in range(1000)]
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"PermSet": {
+            "Type": "AWS::SSO::PermissionSet", "Properties": {"PolicyDocument": {"Version": "2012-10-17", "Statement": statements}}}}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertTrue(result["errorMessage"].startswith("PermSet: InlinePolicy is "))
+        self.assertTrue(result["errorMessage"].endswith("bytes, more than the limit of 32768"))
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "", "LOOKUPTABLE_PREFIX": "", "IDENTITYSTORE_ID": "d-1234567890"})
+    def testSSOPrincipalNameFromIdentityStore(self):
+        macro.IDENTITYSTORE_CLIENT = StubIdentityStoreClient({"arjen": "user-123"}, {"Admins": "group-456"})
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "AssmntA": assignment("USER", "arjen"),
+            "AssmntB": assignment("GROUP", "Admins"),
+            "AssmntC": assignment("GROUP", "Admins")}}
+        result = macro.handler(event, None)
+        resources = result["fragment"]["Resources"]
+        self.assertEqual(resources["AssmntA"]["Properties"]["PrincipalId"], "user-123")
+        self.assertEqual(resources["AssmntB"]["Properties"]["PrincipalId"], "group-456")
+        self.assertEqual(resources["AssmntC"]["Properties"]["PrincipalId"], "group-456")
+        self.assertRaises(KeyError, lambda: resources["AssmntA"]["Properties"]["PrincipalName"])
+        calls = sorted(macro.IDENTITYSTORE_CLIENT.calls)
+        self.assertEqual(calls, [("d-1234567890", "displayName", "Admins"), ("d-1234567890", "userName", "arjen")])
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "", "LOOKUPTABLE_PREFIX": "", "IDENTITYSTORE_ID": "d-1234567890"})
+    def testSSOPrincipalNamesCachedBetweenInvocations(self):
+        macro.IDENTITYSTORE_CLIENT = StubIdentityStoreClient({}, {"Admins": "group-456"})
+        for _ in range(2):
+            event = {}
+            event["region"] = "ap-southeast-2"
+            event["requestId"] = "testRequest"
+            event["fragment"] = {"Resources": {"Assmnt": assignment("GROUP", "Admins")}}
+            result = macro.handler(event, None)
+            self.assertEqual(result["fragment"]["Resources"]["Assmnt"]["Properties"]["PrincipalId"], "group-456")
+        self.assertEqual(len(macro.IDENTITYSTORE_CLIENT.calls), 1)
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "testbucket", "LOOKUPTABLE_PREFIX": "lookuptable.json", "IDENTITYSTORE_ID": "d-1234567890"})
+    def testSSOPrincipalNameFallsBackToLookupTable(self):
+        macro.IDENTITYSTORE_CLIENT = StubIdentityStoreClient({}, {"Admins": "group-456"})
+        macro.S3_CLIENT = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "AssmntA": assignment("USER", "My Name"),
+            "AssmntB": assignment("GROUP", "Admins")}}
+        result = macro.handler(event, None)
+        resources = result["fragment"]["Resources"]
+        self.assertEqual(resources["AssmntA"]["Properties"]["PrincipalId"], "abcdef-123456")
+        self.assertEqual(resources["AssmntB"]["Properties"]["PrincipalId"], "group-456")
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "", "LOOKUPTABLE_PREFIX": "", "IDENTITYSTORE_ID": "d-1234567890"})
+    def testSSOPrincipalNameNotFoundFails(self):
+        macro.IDENTITYSTORE_CLIENT = StubIdentityStoreClient({}, {})
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Assmnt": assignment("GROUP", "Admins")}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"], "Assmnt: PrincipalName Admins can't be found")
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "", "LOOKUPTABLE_PREFIX": "", "IDENTITYSTORE_ID": "d-1234567890"})
+    def testSSOPrincipalTypeWithIntrinsicFails(self):
+        macro.IDENTITYSTORE_CLIENT = StubIdentityStoreClient({"arjen": "user-123"}, {})
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {
+            "AssmntA": assignment("USER", "arjen"),
+            "AssmntB": assignment({"Ref": "PrincipalType"}, "arjen")}}
+        self.assertEqual(macro.principal_names(event["fragment"]), set([("USER", "arjen")]))
+        result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        self.assertEqual(result["errorMessage"],
+                         "AssmntB: PrincipalName can only be looked up when it and PrincipalType are strings")
+
+    def testLookupIndexFindsNames(self):
+        table = dict(("User %05d" % i, "id-%d" % i) for i in range(1000))
+        table["Zoë"] = "id-unicode"
+        with tempfile.TemporaryDirectory() as cachedir:
+            path = os.path.join(cachedir, "index.tsv")
+            with open(path, "wb") as indexfile:
+                indexfile.write(macro.build_lookup_index(table))
+            index = macro.LookupIndex(path)
+            for name, principal_id in table.items():
+                self.assertEqual(index[name], principal_id)
+            self.assertNotIn("User 1000", index)
+            self.assertNotIn("", index)
+            self.assertRaises(KeyError, lambda: index["Nobody"])
+
+    def testLookupIndexEmpty(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            path = os.path.join(cachedir, "index.tsv")
+            open(path, "wb").close()
+            self.assertNotIn("My Name", macro.LookupIndex(path))
+
+    def testLookupIndexRejectsTabs(self):
+        self.assertRaises(ValueError, macro.build_lookup_index, {"My\tName": "abcdef-123456"})
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "testbucket", "LOOKUPTABLE_PREFIX": "lookuptable.tsv"})
+    def testSSOPrincipalNameFromLookupIndex(self):
+        index = macro.build_lookup_index({"My Name": "abcdef-123456", "Other Name": "ghijkl-789012"})
+        macro.S3_CLIENT = StubS3Client(index.decode('utf-8'), "\"etag1\"")
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Assmnt": assignment("USER", "My Name")}}
+        result = macro.handler(event, None)
+        self.assertEqual(result["fragment"]["Resources"]["Assmnt"]["Properties"]["PrincipalId"], "abcdef-123456")
+
+    def testLookupTableReadFromDiskCache(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        # A new execution environment only has the files in /tmp
+        macro.LOOKUP_CACHE.clear()
+        result = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(result, {"My Name": "abcdef-123456"})
+        self.assertEqual(len(s3.calls), 1)
+        self.assertEqual(macro.DISK_CACHE_STATS, {"hits": 1, "misses": 1})
+
+    @mock.patch.dict(os.environ, {"LOOKUPTABLE_CACHE_TTL": "0"})
+    def testDiskCacheRevalidatedWithETag(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        macro.LOOKUP_CACHE.clear()
+        s3.content = "{\"My Name\":\"ghijkl-789012\"}"
+        s3.etag = "\"etag2\""
+        result = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(s3.calls[1]["IfNoneMatch"], "\"etag1\"")
+        self.assertEqual(result, {"My Name": "ghijkl-789012"})
+        self.assertEqual(macro.DISK_CACHE_STATS, {"hits": 0, "misses": 2})
+
+    def testDiskCacheIgnoresOtherVersions(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        macro.LOOKUP_CACHE.clear()
+        with mock.patch.object(macro, "DISK_CACHE_VERSION", macro.DISK_CACHE_VERSION + 1):
+            macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(len(s3.calls), 2)
+        self.assertNotIn("IfNoneMatch", s3.calls[1])
+
+    def testDiskCacheEvictsOldestWhenFull(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        with mock.patch.dict(os.environ, {"LOOKUPTABLE_DISK_CACHE_MAX_BYTES": "40"}):
+            macro.get_lookup_table(s3, "testbucket", "first.json")
+            macro.get_lookup_table(s3, "testbucket", "second.json")
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         sorted(os.path.basename(path) for path in macro.disk_cache_paths("testbucket", "second.json")))
+
+    def testDiskCacheEvictsExpired(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "first.json")
+        with mock.patch.dict(os.environ, {"LOOKUPTABLE_DISK_CACHE_MAX_AGE": "-1"}):
+            macro.get_lookup_table(s3, "testbucket", "second.json")
+        self.assertEqual(sorted(os.listdir(self.cachedir)),
+                         sorted(os.path.basename(path) for path in macro.disk_cache_paths("testbucket", "second.json")))
+
+    def testDiskCacheFullKeepsTableInMemory(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        full = OSError(errno.ENOSPC, "No space left on device")
+        with mock.patch.object(macro.shutil, "copyfileobj", side_effect=full):
+            result = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(result, {"My Name": "abcdef-123456"})
+        self.assertEqual(len(s3.calls), 2)
+        self.assertEqual(os.listdir(self.cachedir), [])
+        # The table is still cached in memory
+        self.assertEqual(macro.get_lookup_table(s3, "testbucket", "lookuptable.json"), result)
+        self.assertEqual(len(s3.calls), 2)
+
+    def testDiskCacheReadOnlyKeepsIndexInMemory(self):
+        index = macro.build_lookup_index({"My Name": "abcdef-123456"})
+        s3 = StubS3Client(index.decode('utf-8'), "\"etag1\"")
+        readonly = OSError(errno.EROFS, "Read-only file system")
+        with mock.patch.object(macro.tempfile, "NamedTemporaryFile", side_effect=readonly):
+            result = macro.get_lookup_table(s3, "testbucket", "lookuptable.tsv")
+        self.assertEqual(result["My Name"], "abcdef-123456")
+        self.assertNotIn("Other Name", result)
+
+    def testDiskCacheMetadataFailureKeepsTable(self):
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        full = OSError(errno.ENOSPC, "No space left on device")
+        with mock.patch.object(macro, "write_disk_cache_metadata", side_effect=full):
+            result = macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(result, {"My Name": "abcdef-123456"})
+        self.assertEqual(len(s3.calls), 1)
+        self.assertEqual(os.listdir(self.cachedir), [])
+
+    def testDiskCacheEvictsOrphanedTemporaryFiles(self):
+        for name in ["ssofixer-old.tmp", "ssofixer-new.tmp"]:
+            open(os.path.join(self.cachedir, name), "wb").close()
+        old = time.time() - macro.DISK_CACHE_TEMPORARY_MAX_AGE - 1
+        os.utime(os.path.join(self.cachedir, "ssofixer-old.tmp"), (old, old))
+        s3 = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        macro.get_lookup_table(s3, "testbucket", "lookuptable.json")
+        self.assertEqual(sorted(os.listdir(self.cachedir)), sorted(
+            ["ssofixer-new.tmp"] + [os.path.basename(path) for path in macro.disk_cache_paths("testbucket", "lookuptable.json")]))
+
+    @mock.patch.dict(os.environ, {"BUCKET_NAME": "testbucket", "LOOKUPTABLE_PREFIX": "lookuptable.json",
+                                  "METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsLoggedAsEMF(self):
+        macro.S3_CLIENT = StubS3Client("{\"My Name\":\"abcdef-123456\"}", "\"etag1\"")
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"Assmnt": assignment("USER", "My Name")}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(event, None)
+            macro.handler(event, None)
+        first, second = emitted_metrics(output.getvalue())
+        definition = second["_aws"]["CloudWatchMetrics"][0]
+        self.assertEqual(definition["Namespace"], "CloudFormationMacros")
+        self.assertEqual(definition["Dimensions"], [["Macro"]])
+        for metric in definition["Metrics"]:
+            self.assertIn(metric["Name"], second)
+        self.assertEqual(second["Macro"], "SSOFixer")
+        self.assertEqual(second["RequestId"], "testRequest")
+        self.assertEqual((second["ResourcesIn"], second["ResourcesOut"], second["Failures"]), (1, 1, 0))
+        self.assertEqual((first["LookupCacheMisses"], first["LookupCacheHitRate"]), (1, 0.0))
+        self.assertEqual((second["LookupCacheHits"], second["LookupCacheHitRate"]), (1, 100.0))
+        self.assertIn("LookupFetchTime", first)
+        self.assertNotIn("LookupFetchTime", second)
+        for phase in ["LookupTime", "ExpandTime", "InvocationTime"]:
+            self.assertGreaterEqual(second[phase], 0)
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsCountFailures(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {"PermSet": {"Type": "AWS::SSO::PermissionSet", "Properties": {
+            "PolicyDocument": {"Statement": [{"Effect": "Allow", "Action": "s3:GetObject", "Resource": "x" * 40000}]}}}}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result = macro.handler(event, None)
+        self.assertEqual(result["status"], "failure")
+        metrics, = emitted_metrics(output.getvalue())
+        self.assertEqual(metrics["Failures"], 1)
+        self.assertNotIn("ResourcesOut", metrics)
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": "CloudFormationMacros"})
+    def testMetricsKeepTheOriginalError(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(KeyError) as raised:
+                macro.handler({"region": "ap-southeast-2"}, None)
+        self.assertEqual(raised.exception.args, ("requestId",))
+        metrics, = emitted_metrics(output.getvalue())
+        self.assertEqual((metrics["Failures"], metrics["ResourcesIn"]), (1, 0))
+
+    @mock.patch.dict(os.environ, {"METRICS_NAMESPACE": ""})
+    def testMetricsDisabled(self):
+        event = {}
+        event["region"] = "ap-southeast-2"
+        event["requestId"] = "testRequest"
+        event["fragment"] = {"Resources": {}}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            macro.handler(event, None)
+        self.assertEqual(emitted_metrics(output.getvalue()), [])
+
+
 if __name__ == '__main__':
     unittest.main()
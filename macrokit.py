@@ -0,0 +1,122 @@
+# Shared by the macros in this repository. Every macro is packaged on its own,
+# so each of their directories links to this file instead of copying it.
+import contextlib
+import functools
+import json
+import os
+import time
+
+
+def transform_resources(fragment, handlers, *args):
+    # Walk the resources once and return the transformed fragment.
+    #
+    # handlers maps a resource Type to a function that receives the logical
+    # ID, the definition and the args, and returns (or yields) the
+    # (section, logical ID, value) entries that replace the resource. A
+    # resource that should stay has to be returned as well. The entries are
+    # consumed once the walk is done, so a handler can stream them, and every
+    # handled resource is removed first, so an entry can reuse its logical ID.
+    #
+    # The fragment that's passed in isn't changed: the result gets its own
+    # dict for every section that gets entries, and everything that isn't
+    # replaced is shared with the original.
+    result = dict(fragment)
+    resources = dict(fragment['Resources'])
+    result['Resources'] = resources
+    copied = {'Resources'}
+    pending = []
+    for resource, definition in fragment['Resources'].items():
+        resource_handler = handlers.get(definition.get('Type'))
+        if resource_handler is not None:
+            del resources[resource]
+            pending.append(resource_handler(resource, definition, *args))
+    for entries in pending:
+        for section, name, value in entries:
+            if section not in copied:
+                result[section] = dict(fragment.get(section, {}))
+                copied.add(section)
+            result[section][name] = value
+    return result
+
+
+def metrics_namespace():
+    # An empty namespace turns the metrics off
+    return os.environ.get('METRICS_NAMESPACE', 'CloudFormationMacros')
+
+
+class Metrics:
+    # The timings (in milliseconds) and counts of one invocation, logged as a
+    # single CloudWatch Embedded Metric Format line. CloudWatch Logs turns it
+    # into metrics with the macro as dimension, without any API calls.
+    def __init__(self, macro):
+        self.macro = macro
+        self.values = {}
+        self.units = {}
+
+    def add(self, name, value, unit="Count"):
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name + "Time", (time.perf_counter() - start) * 1000, "Milliseconds")
+
+    def emit(self, namespace, request_id):
+        values = dict(self.values)
+        units = dict(self.units)
+        # Every cache with hits or misses also gets its hit rate
+        for name in self.values:
+            if name.endswith("Hits") or name.endswith("Misses"):
+                cache = name[:-len("Hits")] if name.endswith("Hits") else name[:-len("Misses")]
+                hits = self.values.get(cache + "Hits", 0)
+                total = hits + self.values.get(cache + "Misses", 0)
+                values[cache + "HitRate"] = 100.0 * hits / total if total else 0.0
+                units[cache + "HitRate"] = "Percent"
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [["Macro"]],
+                    "Metrics": [{"Name": name, "Unit": units[name]} for name in values]
+                }]
+            },
+            "Macro": self.macro,
+            "RequestId": request_id
+        }
+        record.update(values)
+        print(json.dumps(record))
+
+
+def instrumented(macro):
+    # Turns a function that takes the event, the context and the Metrics into
+    # a handler that logs the metrics of every invocation: the phases the
+    # function timed, how long the whole invocation took, and the number of
+    # resources before and after. The response isn't serialised to measure
+    # it, as that would take about as long as the macro itself.
+    def decorator(transform):
+        @functools.wraps(transform)
+        def wrapper(event, context):
+            namespace = metrics_namespace()
+            metrics = Metrics(macro)
+            if not namespace:
+                return transform(event, context, metrics)
+            start = time.perf_counter()
+            succeeded = False
+            try:
+                response = transform(event, context, metrics)
+                succeeded = response['status'] == "success"
+                if succeeded:
+                    metrics.add("ResourcesOut", len(response['fragment'].get('Resources', {})))
+                return response
+            finally:
+                metrics.add("InvocationTime", (time.perf_counter() - start) * 1000, "Milliseconds")
+                metrics.add("ResourcesIn", len(event.get('fragment', {}).get('Resources', {})))
+                metrics.add("Failures", 0 if succeeded else 1)
+                metrics.emit(namespace, event.get('requestId'))
+        return wrapper
+    return decorator